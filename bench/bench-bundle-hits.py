@@ -0,0 +1,105 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import filecmp
+import optparse
+import tempfile
+import subprocess
+
+"""
+Times bundle-hits.py on generated items, and reports bundles/sec, for two kinds of batch:
+
+  plain  many short plain columns: 20 fields per item, 8 items per HIT
+  html   a ~2 KB HTML content field per item, with --htmlize content
+         and --jsonize concepts, 10 items per HIT
+
+The items are made from a fixed seed, so runs are comparable.  With
+--baseline, another copy of the script is timed on the same input and the
+outputs are checked to be identical, e.g. against the version before a change:
+
+    git show HEAD~1:src/bundle-hits.py > /tmp/old-bundle-hits.py
+    python bench/bench-bundle-hits.py --baseline /tmp/old-bundle-hits.py
+
+A baseline copy outside src needs PYTHONPATH=src if it imports blobstore.
+"""
+
+######################################################################
+
+def makeItems (filename, kind, nItems, rng):
+    words = ["w%d" % i for i in xrange(2000)] + [u"caf\xe9", u"na\xefve", "<b>", "&amp;"]
+    with open(filename, "w") as f:
+        for i in xrange(nItems):
+            item = dict(itemID="I%06d" % i)
+            if kind == "plain":
+                item.update(("field%02d" % k, " ".join(rng.choice(words) for w in xrange(3))) for k in xrange(19))
+            else:
+                item["content"] = "<p>%s</p>" % " ".join(rng.choice(words) for w in xrange(300))
+                item["concepts"] = dict(A=dict(conceptID="A%d" % rng.randrange(100), gloss=rng.choice(words)))
+            print >>f, json.dumps(item, sort_keys=True)
+
+scenarios = dict(plain=["-n", "8"],
+                 html=["-n", "10", "--htmlize", "content", "--jsonize", "concepts"])
+
+def timeScript (script, args, output, repeat):
+    """Best wall-clock time of repeat runs"""
+    best = None
+    with open(os.devnull, "w") as devnull:
+        for r in xrange(repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable, script, "-o", output] + args, stderr=devnull)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+######################################################################
+
+optparser = optparse.OptionParser(usage="%prog [options] [plain|html ...]")
+optparser.add_option("--script", metavar="FILE",
+                     default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "bundle-hits.py"),
+                     help="Script to time (default the one in src)")
+optparser.add_option("--baseline", metavar="FILE", help="Also time this copy of the script, and compare outputs")
+optparser.add_option("--items", type="int", default=40000, help="Items per batch (default %default)")
+optparser.add_option("--repeat", type="int", default=5, help="Report the best of this many runs (default %default)")
+optparser.add_option("--seed", type="int", default=0, help="Random seed for the items (default %default)")
+
+(options, kinds) = optparser.parse_args()
+kinds = kinds or sorted(scenarios, reverse=True)
+assert set(kinds).issubset(scenarios), "Kinds of batch are %s" % " ".join(sorted(scenarios))
+
+tmp = tempfile.mkdtemp()
+try:
+    for kind in kinds:
+        items = os.path.join(tmp, kind + ".json")
+        makeItems(items, kind, options.items, random.Random(options.seed))
+        args = scenarios[kind] + [items]
+        nBundles = options.items // int(args[1])
+        outputs = []
+        for name, script in (("baseline", options.baseline), ("script", options.script)):
+            if script:
+                output = os.path.join(tmp, "%s-%s.csv" % (kind, name))
+                elapsed = timeScript(script, args, output, options.repeat)
+                print "%-6s %-8s %s: %d bundles in %.2fs, %.1f bundles/sec" % (kind, name, script, nBundles, elapsed, nBundles / elapsed)
+                outputs.append(output)
+        if len(outputs) == 2:
+            print "%-6s outputs are %s" % (kind, "identical" if filecmp.cmp(outputs[0], outputs[1], shallow=False) else "DIFFERENT")
+finally:
+    shutil.rmtree(tmp)
+
+######################################################################
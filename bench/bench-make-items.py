@@ -0,0 +1,113 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import filecmp
+import optparse
+import tempfile
+import subprocess
+
+"""
+Times new-make-items.py on generated documents, and reports items/sec.
+
+The documents are made from a fixed seed, so runs are comparable.  With
+--baseline, another copy of the script is timed on the same input and the
+outputs are checked to be identical, e.g. against the version before a change:
+
+    git show HEAD~1:src/new-make-items.py > /tmp/old-make-items.py
+    python bench/bench-make-items.py --baseline /tmp/old-make-items.py
+
+Versions from before readDocs used "docID" need that, and the re import,
+to run at all:
+
+    sed -i -e 's/^import sys$/import sys\nimport re/' -e 's/doc\["id"\]/doc["docID"]/' /tmp/old-make-items.py
+"""
+
+######################################################################
+
+def makeDocs (filename, nDocs, size, nGroups, conceptTypes, rng):
+    """Documents of about size characters, each with nGroups concept groups per type.
+    The annotated spans never overlap, as new-make-items.py requires."""
+    with open(filename, "w") as f:
+        for d in xrange(nDocs):
+            words = ["w%d" % rng.randrange(10000) for i in xrange(size // 6)]
+            starts = []
+            pos = 0
+            for word in words:
+                starts.append(pos)
+                pos += len(word) + 1
+            content = " ".join(words)
+            # Every other word can start a span, so spans are disjoint
+            slots = range(0, len(words) - 1, 2)
+            rng.shuffle(slots)
+            annotations = []
+            for conceptType in conceptTypes:
+                for g in xrange(nGroups):
+                    spans = [slots.pop() for i in xrange(5)]
+                    annotations.append(dict(type=conceptType, conceptID="%s%d" % (conceptType, g),
+                                            offsets=sorted([starts[w], starts[w] + len(words[w])] for w in spans)))
+            print >>f, json.dumps(dict(docID="D%d" % d, content=content, annotations=annotations))
+
+def timeScript (script, args, output, repeat):
+    """Best wall-clock time of repeat runs"""
+    best = None
+    with open(os.devnull, "w") as devnull:
+        for r in xrange(repeat):
+            with open(output, "w") as out:
+                start = time.time()
+                subprocess.check_call([sys.executable, script] + args, stdout=out, stderr=devnull)
+                elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+######################################################################
+
+optparser = optparse.OptionParser(usage="%prog [options]")
+optparser.add_option("--script", metavar="FILE",
+                     default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "new-make-items.py"),
+                     help="Script to time (default the one in src)")
+optparser.add_option("--baseline", metavar="FILE", help="Also time this copy of the script, and compare outputs")
+optparser.add_option("--docs", type="int", default=3, help="Number of documents (default %default)")
+optparser.add_option("--size", type="int", default=360000, help="Characters per document (default %default)")
+optparser.add_option("--groups", type="int", default=16,
+                     help="Concept groups per type and document, so groups^2 items per document (default %default)")
+optparser.add_option("--repeat", type="int", default=3, help="Report the best of this many runs (default %default)")
+optparser.add_option("--seed", type="int", default=0, help="Random seed for the documents (default %default)")
+
+(options, args) = optparser.parse_args()
+
+tmp = tempfile.mkdtemp()
+try:
+    docs = os.path.join(tmp, "docs.json")
+    makeDocs(docs, options.docs, options.size, options.groups, ["A", "B"], random.Random(options.seed))
+    args = ["--concepts", "A B", docs]
+    nItems = options.docs * options.groups ** 2
+    outputs = []
+    for name, script in (("baseline", options.baseline), ("script", options.script)):
+        if script:
+            output = os.path.join(tmp, name + ".json")
+            elapsed = timeScript(script, args, output, options.repeat)
+            print "%-8s %s: %d items in %.2fs, %.1f items/sec" % (name, script, nItems, elapsed, nItems / elapsed)
+            outputs.append(output)
+    if len(outputs) == 2:
+        print "Outputs are %s" % ("identical" if filecmp.cmp(outputs[0], outputs[1], shallow=False) else "DIFFERENT")
+finally:
+    shutil.rmtree(tmp)
+
+######################################################################
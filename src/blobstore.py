@@ -0,0 +1,77 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sys
+import os
+import hashlib
+
+"""
+A content-addressed store for item payloads, such as the content HTML.
+
+Each distinct value is written once, as UTF-8, to DIR/ab/abcdef... named by
+its SHA-1 digest, so the directory can be uploaded as is (as make-qual.py
+assumes for label text) and HITs can carry just the digest.
+
+bundle-hits.py --dedup puts values into a store, and unbundle-hits.py
+--rehydrate gets them back.
+"""
+
+######################################################################
+
+class blobStore:
+
+    cacheSize = 1024        # Recently read values, as each HIT's are read once per assignment
+
+    def __init__ (self, path):
+        self.path = path
+        self.digests = set()
+        self.cache = {}
+        self.nValues = self.nBytes = self.nStoredBytes = 0
+
+    def filename (self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def put (self, value):
+        """Stores value if it is new, and returns its digest"""
+        assert isinstance(value, basestring), "Only strings can be stored, not %r" % (value, )
+        data = value.encode("utf8") if isinstance(value, unicode) else value
+        digest = hashlib.sha1(data).hexdigest()
+        self.nValues += 1
+        self.nBytes += len(data)
+        if digest not in self.digests:
+            self.digests.add(digest)
+            filename = self.filename(digest)
+            if not os.path.exists(filename):
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+                # Written under a temporary name, so a store never has a partial blob
+                with open(filename + ".tmp", "wb") as f:
+                    f.write(data)
+                os.rename(filename + ".tmp", filename)
+            self.nStoredBytes += len(data)
+        return digest
+
+    def get (self, digest):
+        value = self.cache.get(digest)
+        if value is None:
+            if len(self.cache) >= self.cacheSize:
+                self.cache.clear()
+            with open(self.filename(digest), "rb") as f:
+                value = self.cache[digest] = f.read().decode("utf8")
+        return value
+
+    def report (self):
+        print >>sys.stderr, "%s: %d values, %d distinct; %d of %d bytes stored in %s" % (
+            self, self.nValues, len(self.digests), self.nStoredBytes, self.nBytes, self.path)
+
+######################################################################
@@ -23,12 +23,26 @@ import json
 import itertools
 import optparse
 import cgi
+import os
+import array
+import blobstore
 
 """
 Reads HIT items and bundles them into fixed size HITs.
 This is accomplished by appending sequential numerics onto the field names.
 
 This can also inject control items at a specified rate, reusing them if necessary.
+
+A named input file is read twice, first for offsets and field names and then item by item
+as the bundles are written, so batches larger than memory can be bundled.
+With --random only the offsets are shuffled, and the items read back in that order.
+
+With --dedup, repeated payloads (e.g. the same label HTML for many concept pairs) are
+stored once in a content-addressed directory (see blobstore.py) and the HITs carry their digests;
+unbundle-hits.py --rehydrate puts the values back.
+
+With --tiers, workers are grouped by past accuracy (--accuracy) and each group gets
+its own batch and gold rate, so trusted workers see fewer controls.
 """
 
 ######################################################################
@@ -61,6 +75,116 @@ class jsonItemReader:
                 raise
             n += 1
 
+class jsonItemFile:
+    """A JSON-lines item file that can be read back an item at a time by byte offset"""
+
+    def __init__ (self, path):
+        self.path = path
+        self.file = open(path, "rb")
+
+    def parse (self, line):
+        item = json.loads(line.decode("utf8"))
+        item["itemID"] = str(item["itemID"])
+        return item
+
+    def scan (self):
+        """Yields (offset, item) for each line, in order"""
+        self.file.seek(0)
+        offset = 0
+        while True:
+            line = self.file.readline()
+            if not line:
+                break
+            yield offset, self.parse(line)
+            offset += len(line)
+
+    def read (self, offset):
+        self.file.seek(offset)
+        return self.parse(self.file.readline())
+
+class itemList:
+    """A list-like sequence of items from a jsonItemFile.
+    Only the offsets and (shared) key lists are held in memory; items are read when indexed.
+    Any extra fields are added to each item as it is read."""
+
+    def __init__ (self, source, extra={}):
+        self.source = source
+        self.extra = extra
+        self.offsets = array.array("l")
+        self.schemaCodes = array.array("i")
+        self.schemas = {}
+        self.schemaList = []
+
+    def append (self, offset, item):
+        schema = tuple(sorted(set(item).union(self.extra)))
+        code = self.schemas.get(schema)
+        if code is None:
+            code = self.schemas[schema] = len(self.schemaList)
+            self.schemaList.append(schema)
+        self.offsets.append(offset)
+        self.schemaCodes.append(code)
+
+    def __len__ (self):
+        return len(self.offsets)
+
+    def __getitem__ (self, i):
+        item = self.source.read(self.offsets[i])
+        item.update(self.extra)
+        return item
+
+    def keys (self, i):
+        return self.schemaList[self.schemaCodes[i]]
+
+    def part (self, start, end):
+        """The items from start to end, sharing this list's source and key lists"""
+        part = itemList(self.source, self.extra)
+        part.schemas, part.schemaList = self.schemas, self.schemaList
+        part.offsets = self.offsets[start:end]
+        part.schemaCodes = self.schemaCodes[start:end]
+        return part
+
+    def shuffle (self):
+        """Shuffles just the offsets (and key lists), into the order random.shuffle would give the items"""
+        order = array.array("l", xrange(len(self)))
+        random.shuffle(order)
+        self.offsets = array.array("l", (self.offsets[i] for i in order))
+        self.schemaCodes = array.array("i", (self.schemaCodes[i] for i in order))
+
+def shuffleItems (items):
+    if isinstance(items, itemList):
+        items.shuffle()
+    else:
+        random.shuffle(items)
+
+def itemKeys (items, i):
+    """The keys of items[i], without reading it from an itemList"""
+    return items.keys(i) if isinstance(items, itemList) else items[i]
+
+def indexItems (source, unique=False, gold=None):
+    """One pass over a jsonItemFile, doing what uniquify and separateGold do
+    to a list, but returning itemLists of test items and gold.
+    gold is a goldIndex, if any"""
+    items = itemList(source)
+    goldItems = itemList(source, extra={"isGold": 1})
+    seen = set()
+    dropped = 0
+    for offset, item in source.scan():
+        if unique:
+            id = item["itemID"]
+            if id in seen:
+                dropped += 1
+                continue
+            seen.add(id)
+        if gold is not None and gold.isGold(item):
+            goldItems.append(offset, item)
+        else:
+            items.append(offset, item)
+    if dropped:
+        print >>sys.stderr, "Dropped %d duplicate itemIDs" % dropped
+    if gold is not None:
+        gold.report()
+    return items, goldItems
+
 class tabItemReader:
 
     def __init__ (self, file):
@@ -93,6 +217,20 @@ def cleanValues (items):
                     print >>sys.stderr, ("Changed %s from\n%s to\n%s" % (key, value, item[key])).encode("utf8")     
         yield item
 
+jsonEncode = json.JSONEncoder(ensure_ascii=True, sort_keys=True).encode
+
+def plainEncode (value):
+    return unicode(value).encode("utf8").replace("\n", " ")
+
+def htmlEncode (value):
+    return cgi.escape(value).replace("\n", " ").encode("ascii", "xmlcharrefreplace")
+
+def columnEncoders (keys, jsonize=(), htmlize=()):
+    """The encoder for each column of the header, decided once.
+    Plain columns get None, and are encoded inline (it is most of them)"""
+    return [jsonEncode if key in jsonize else htmlEncode if key in htmlize else None
+            for key in keys]
+
 def writeBundles (outFile, items, keys=None, jsonize=(), htmlize=()):
     if not keys:
         items = list(items)
@@ -101,27 +239,42 @@ def writeBundles (outFile, items, keys=None, jsonize=(), htmlize=()):
             keys = keys.union(item)
         keys = sorted(keys)
 
-    writer = csv.DictWriter(maybeOpen(outFile, "w", None), keys)
-    try:
-        writer.writeheader()    # ARGH!
-    except AttributeError:
-        writer.writerow(dict(zip(keys, keys)))
+    writer = csv.writer(maybeOpen(outFile, "w", None))
+    writer.writerow(keys)
+    columns = zip(keys, columnEncoders(keys, jsonize=jsonize, htmlize=htmlize))
+    keySet = set(keys)
+    n = 0
     for bundle in items:
-        for key, value in bundle.iteritems():
-            if key in jsonize:
-                bundle[key] = json.dumps(value, ensure_ascii=True, sort_keys=True)
-            elif key in htmlize:
-                bundle[key] = cgi.escape(value).replace("\n", " ").encode("ascii", "xmlcharrefreplace")
-            else:
-                bundle[key] = unicode(value).encode("utf8").replace("\n", " ")
-        # print >>sys.stderr, bundle.keys()
-        writer.writerow(bundle)
+        try:
+            row = [unicode(bundle[key]).encode("utf8").replace("\n", " ") if encode is None else encode(bundle[key])
+                   for (key, encode) in columns]
+        except KeyError:
+            # Not every item has every field
+            row = ["" if key not in bundle else
+                   unicode(bundle[key]).encode("utf8").replace("\n", " ") if encode is None else encode(bundle[key])
+                   for (key, encode) in columns]
+        if not keySet.issuperset(bundle):
+            raise ValueError("Fields not in header: %s" % ", ".join(sorted(set(bundle).difference(keys))))
+        writer.writerow(row)
+        n += 1
+    print >>sys.stderr, "Wrote %d bundles" % n
+
+def dedupBundles (bundles, store, encoders):
+    """Replaces the values of fields with their digests, putting each distinct value in store once.
+    encoders maps each field to its column encoder, so what is stored is just what
+    writeBundles would have put in the cell, and unbundling gets back the same thing"""
+    fields = set(encoders)
+    for bundle in bundles:
+        for key in fields.intersection(bundle):
+            bundle[key] = store.put(encoders[key](bundle[key]))
+        yield bundle
+    store.report()
 
 ######################################################################
 #
 # Bundle
 
-import math
+import fractions
 
 class itemBundler:
 
@@ -132,40 +285,45 @@ class itemBundler:
         self.nBundle = n
         self.itemSuffix = itemSuffix
         self.verbose = verbose
-        self.items = list(items)
-        self.controls = list(controlItems)
+        # itemLists are used as is, so their items are only read as they are bundled
+        self.items = items if isinstance(items, itemList) else list(items)
+        self.controls = controlItems if isinstance(controlItems, itemList) else list(controlItems)
         self.randomize = randomize
         if randomize:
-            random.shuffle(self.items)
-            random.shuffle(self.controls)
+            shuffleItems(self.items)
+            shuffleItems(self.controls)
         self.controlRate = float(controlRate)
-        self.adjustControlRate()
-        assert 0.0 <= self.controlRate <= 1.0
-
-    def adjustControlRate (self):
-        """Play with the control rate so we don't end up with any partial bundles.
-        This still isn't quite right, what we need to do is go to all integers,
-        including total number of controls"""
-        controlRate = self.controlRate
-        if controlRate == 0:
+        assert 0.0 <= self.controlRate < 1.0
+        self.planBundles()
+
+    def planBundles (self):
+        """Decides up front, in integers, how many bundles there will be and how many
+        of their slots go to controls: the fewest bundles that hold all the items and whose
+        control slots are at least controlRate of the total, rounded to the nearest slot.
+        schedule spreads the control slots evenly over the bundles."""
+        nItems = len(self.items)
+        n = self.nBundle
+        if not self.controls:
+            self.nBundles = nItems // n
+            self.nControlSlots = 0
+            if nItems % n:
+                print >>sys.stderr, "No controls to fill out a bundle, leaving out the last %d items" % (nItems % n)
             return
-        testItems = len(self.items)
-        bundleSize = self.nBundle
-        totalBundles = testItems / ((1 - controlRate) * bundleSize)
-        if abs(totalBundles - int(totalBundles)) > 0.001:
-            if self.verbose > 1:
-                print >>sys.stderr, "Expected number of bundles is fractional (%.3f)" % totalBundles
-            totalBundles = math.ceil(totalBundles)
-            totalItems = totalBundles * bundleSize
-            controlItems = totalItems - testItems
-            if self.verbose > 1:
-                print >>sys.stderr, "Adjusting number of bundles to %.3f" % totalBundles
-                print >>sys.stderr, "Adjusting number of total items to %d" % totalItems
-                print >>sys.stderr, "Adjusting number of control items to %d" % controlItems
-            controlRate = controlItems / totalItems
+        # The rate is usually 1/n or a short decimal, which this recovers exactly
+        rate = fractions.Fraction(self.controlRate).limit_denominator(10**6)
+        def enough (nBundles):
+            return nBundles * n - nItems >= int(rate * nBundles * n + fractions.Fraction(1, 2))
+        self.nBundles = int(-(-nItems // (n * (1 - rate))))
+        while self.nBundles > 0 and enough(self.nBundles - 1):
+            self.nBundles -= 1
+        self.nControlSlots = self.nBundles * n - nItems
+        if self.nBundles and fractions.Fraction(self.nControlSlots, self.nBundles * n) != rate:
+            controlRate = self.nControlSlots / (self.nBundles * n)
             print >>sys.stderr, "Adjusting control rate from %g to %.6f" % (self.controlRate, controlRate)
             self.controlRate = controlRate
-        
+        if self.verbose > 1:
+            print >>sys.stderr, "Planned %d bundles with %d item and %d control slots" % (self.nBundles, nItems, self.nControlSlots)
+
     def bundle (self, bundleList):
         # if itemSuffix ...
         newBundle = {}
@@ -174,47 +332,60 @@ class itemBundler:
                 newBundle["%s_%d" % (key, i + 1)] = val
         return newBundle
 
-    def __iter__ (self):
-        # Fill bundle and add controls if ratio is insufficient ...
-        # assert (1 - self.controlRate) * self.nBundle >= 1
-        # assert (len(self.controls) / (len(self.controls) + len(self.items))) > self.controlRate
-
-        bundleList = []
-        controls = itertools.cycle(self.controls)       # Reuse controls if necessary
-        controlRate = self.controlRate or 0.0
-        # print >>sys.stderr, self.items
-        items = list(self.items)
-        nBundles = itemsUsed = controlsUsed = 0
-        randomize = self.randomize and controlRate      # No need to randomize again if no control items - OVER-OPTIMIZATION?
-        verbose = self.verbose
-
-        while True:
-            # We should really just explicitly build a full bundle each time through,
-            # then we might not have to adjust the control rate explicitly ...
-            if (itemsUsed + controlsUsed) and verbose > 1:
-                print >>sys.stderr, "(%d / (%d + %d) = %.12f <?> %.12f" % (controlsUsed, itemsUsed, controlsUsed,
-                                                                     (controlsUsed / (itemsUsed + controlsUsed)),
-                                                                     controlRate)
-            if controlsUsed < controlRate * (itemsUsed + controlsUsed) or not items:
-                # Above SHOULD BE same as this: controlsUsed / (itemsUsed + controlsUsed) < controlRate
-                bundleList.append(controls.next())
-                controlsUsed += 1
+    def schedule (self, verbose=0):
+        """Yields each bundle as a list of (isControl, index) slots,
+        without looking at the items themselves.
+        Controls are used in turn, so any reuse is of the least recently used one.
+        Unless the slots are shuffled, a bundle's controls are spread over it and
+        rotated one position per bundle, so every position gets its share of them."""
+        nItems = len(self.items)
+        nControls = len(self.controls)
+        nBundles, nControlSlots = self.nBundles, self.nControlSlots
+        itemsUsed = controlsUsed = 0
+        randomize = self.randomize and nControlSlots    # No need to randomize again if no control items - OVER-OPTIMIZATION?
+
+        for b in xrange(nBundles):
+            nControlsHere = (b + 1) * nControlSlots // nBundles - b * nControlSlots // nBundles
+            nItemsHere = self.nBundle - nControlsHere
+            slots = [(False, nItems - i - 1) for i in xrange(itemsUsed, itemsUsed + nItemsHere)]  # Items are used from the end
+            controls = [(True, c % nControls) for c in xrange(controlsUsed, controlsUsed + nControlsHere)]
+            if controls and not randomize:
+                positions = set((j * self.nBundle // nControlsHere + b) % self.nBundle for j in xrange(nControlsHere))
+                slots, controls = iter(slots), iter(controls)
+                slots = [(controls if p in positions else slots).next() for p in xrange(self.nBundle)]
             else:
-                bundleList.append(items.pop())
-                itemsUsed += 1
-            if len(bundleList) == self.nBundle:
-                if verbose > 2:
-                    print >>sys.stderr, bundleList
-                if randomize:
-                    random.shuffle(bundleList)
-                yield self.bundle(bundleList)
-                nBundles += 1
-                bundleList = []
-                if not items:
-                    break
+                slots.extend(controls)
+            itemsUsed += nItemsHere
+            controlsUsed += nControlsHere
+            if verbose > 1:
+                print >>sys.stderr, "Bundle %d: %d controls, %d / %d so far" % (b + 1, nControlsHere, controlsUsed, itemsUsed + controlsUsed)
+            if randomize:
+                random.shuffle(slots)
+            yield slots
+        assert itemsUsed == nItems or not nControls
+
+    def header (self):
+        """The sorted field names of all the bundles, from a dry run of the schedule
+        over just the items' keys (replaying the same random choices)"""
+        state = random.getstate()
+        keys = set()
+        for slots in self.schedule():
+            for (i, (isControl, index)) in enumerate(slots):
+                keys.update("%s_%d" % (key, i + 1) for key in itemKeys(self.controls if isControl else self.items, index))
+        random.setstate(state)
+        return sorted(keys)
+
+    def __iter__ (self):
+        nBundles = controlsUsed = 0
+        for slots in self.schedule(self.verbose):
+            bundleList = [(self.controls if isControl else self.items)[index] for (isControl, index) in slots]
+            if self.verbose > 2:
+                print >>sys.stderr, bundleList
+            yield self.bundle(bundleList)
+            nBundles += 1
+            controlsUsed += sum(isControl for (isControl, index) in slots)
+        itemsUsed = nBundles * self.nBundle - controlsUsed
         print >>sys.stderr, "Combined %d items with %d controls* into %d %d-bundles" % (itemsUsed, controlsUsed, nBundles, self.nBundle)
-        assert not items
-        assert not bundleList
 
 def computeGoldRate (goldRate, n):
     """Rate can be specified as a fraction, or as the number of items per bundle"""
@@ -229,24 +400,113 @@ def computeGoldRate (goldRate, n):
     print >>sys.stderr, "Gold rate = %.2f" % goldRate
     return goldRate
 
+def readWorkerAccuracy (file):
+    """{WorkerId: (accuracy, volume)} from the per-Turker records of simple-score.py --format json
+    (using the smoothed accuracy), or naive-bayes.py --workers"""
+    workers = {}
+    with open(file) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("WorkerId") and record.get("record", "turker") == "turker":
+                accuracy = record.get("smoothedAccuracy", record.get("accuracy"))
+                if accuracy is not None:
+                    workers[record["WorkerId"]] = (accuracy, record.get("items") or record.get("total") or 0)
+    print >>sys.stderr, "Read accuracy for %d workers from %s" % (len(workers), file)
+    return workers
+
+def planTiers (spec, workers, n):
+    """spec is "ACCURACY:GOLDRATE ...", e.g. "0.85:0.1 0.7:0.2 0:1".
+    Each worker goes in the first tier whose accuracy they reach, and new workers in the last.
+    Returns [(minimum accuracy, gold rate, workerIDs, share of past volume) ...], best tier first"""
+    tiers = []
+    for t in spec.split():
+        accuracy, goldRate = t.split(":")
+        tiers.append((float(accuracy), computeGoldRate(goldRate, n), [], [0]))
+    tiers.sort(key=lambda t: t[0], reverse=True)
+    tiers[-1] = (0.0, ) + tiers[-1][1:]     # Everyone else, including new workers
+    for workerID, (accuracy, volume) in sorted(workers.iteritems()):
+        for (minAccuracy, goldRate, tierWorkers, tierVolume) in tiers:
+            if accuracy >= minAccuracy:
+                tierWorkers.append(workerID)
+                tierVolume[0] += volume
+                break
+    total = sum(tierVolume[0] for (minAccuracy, goldRate, tierWorkers, tierVolume) in tiers)
+    return [(minAccuracy, goldRate, tierWorkers, tierVolume[0] / total if total else 1.0 / len(tiers))
+            for (minAccuracy, goldRate, tierWorkers, tierVolume) in tiers]
+
+def splitItems (items, shares):
+    """Splits items into consecutive parts in proportion to shares (largest remainders get the odd items)"""
+    exact = [len(items) * share / sum(shares) for share in shares]
+    counts = [int(x) for x in exact]
+    for i in sorted(range(len(shares)), key=lambda i: counts[i] - exact[i])[:len(items) - sum(counts)]:
+        counts[i] += 1
+    parts = []
+    start = 0
+    for count in counts:
+        parts.append(items.part(start, start + count) if isinstance(items, itemList) else items[start:start + count])
+        start += count
+    return parts
+
 import collections
-def separateGold (allItems, goldIDs):
-    """For when gold file just has itemID"""
-    allItems = list(allItems)
-    goldIDs = set(i.lower() for i in goldIDs)
-    goldItems = []
-    strawItems = []
-    for item in allItems:
-        if item["itemID"].lower() in goldIDs:
-            item["isGold"] = 1         # add indicator
-            goldItems.append(item)
-        else:
-            strawItems.append(item)
-    print >>sys.stderr, "%d gold found, %d test items (%d)" % (len(goldItems), len(strawItems), len(allItems))
-    # print >>sys.stderr, "Repeated gold: %s" % (list(i for i,c in collections.Counter(i["itemID"].lower() for i in goldItems).iteritems() if c > 1), )
-    missingGold = goldIDs.difference([item["itemID"].lower() for item in goldItems])
-    if missingGold:
-        print >>sys.stderr, "%d gold IDs not found (e.g. %s)" % (len(missingGold), " ".join(list(missingGold)[:3]))
+
+class goldIndex:
+    """The gold item IDs, matched case-insensitively.
+    Keeps track of what it has matched, so the gold that was not found can be reported
+    after a single pass over the items, which may be streamed."""
+
+    def __init__ (self, goldIDs):
+        self.ids = set(i.lower() for i in goldIDs)
+        self.found = set()
+        self.nGold = self.nTest = 0
+
+    @classmethod
+    def read (cls, file):
+        """Gold file just has an itemID at the start of each line"""
+        with open(file) as f:
+            return cls(line.split()[0] for line in f if line.strip())
+
+    def isGold (self, item):
+        id = item["itemID"].lower()
+        if id in self.ids:
+            self.found.add(id)
+            self.nGold += 1
+            return True
+        self.nTest += 1
+        return False
+
+    def partition (self, items):
+        """Splits items, which may be streamed, into lists of gold and test items,
+        doing isGold for each in one tight loop"""
+        ids, found = self.ids, self.found
+        goldItems = []
+        testItems = []
+        addGold, addTest = goldItems.append, testItems.append
+        for item in items:
+            id = item["itemID"].lower()
+            if id in ids:
+                found.add(id)
+                addGold(item)
+            else:
+                addTest(item)
+        self.nGold += len(goldItems)
+        self.nTest += len(testItems)
+        return goldItems, testItems
+
+    def report (self):
+        print >>sys.stderr, "%d gold found, %d test items (%d)" % (self.nGold, self.nTest, self.nGold + self.nTest)
+        missingGold = self.ids.difference(self.found)
+        if missingGold:
+            print >>sys.stderr, "%d gold IDs not found (e.g. %s)" % (len(missingGold), " ".join(list(missingGold)[:3]))
+
+def separateGold (allItems, gold):
+    """Partitions items, which may be streamed, in one pass.
+    gold is a goldIndex, or just the gold itemIDs"""
+    if not isinstance(gold, goldIndex):
+        gold = goldIndex(gold)
+    goldItems, strawItems = gold.partition(allItems)
+    for item in goldItems:
+        item["isGold"] = 1         # add indicator
+    gold.report()
     return goldItems, strawItems    
 
 ######################################################################
@@ -257,11 +517,20 @@ optparser.add_option("-v", "--verbose", dest="verbose", action = "count",
                   help = "More verbose output")
 optparser.add_option("-n", help="Number of items per HIT", type="int", default=2)
 optparser.add_option("-r", "--random", help="Randomize items across hits", action="store_true")
+optparser.add_option("--seed", type="int", metavar="SEED", help="Seed the randomization, for a reproducible batch")
 optparser.add_option("--gold", help="Gold-standard itemids", metavar="FILE")
 optparser.add_option("--goldrate", help="How much gold to insert into each hit", metavar="NUMBER")
+optparser.add_option("--accuracy", metavar="FILE",
+                     help="Per-worker accuracy records from simple-score.py --format json or naive-bayes.py --workers")
+optparser.add_option("--tiers", metavar="SPEC",
+                     help="Write one batch per tier of --accuracy with its own gold rate, e.g. \"0.85:0.1 0.7:0.2 0:1\" "
+                     "(ACCURACY:GOLDRATE, the last tier takes new workers); needs --output")
 optparser.add_option("-o", "--output", help="write HITs to FILE", metavar="FILE")
 optparser.add_option("--jsonize", default=[], action="append", metavar="FIELD", help="Encode each FIELD as JSON")
 optparser.add_option("--htmlize", default=[], action="append", metavar="FIELD", help="Encode each FIELD using HTML numeric char refs")
+optparser.add_option("--dedup", default=[], action="append", metavar="FIELD",
+                     help="Replace each FIELD with the digest of its value, storing each distinct value once in --blobs")
+optparser.add_option("--blobs", metavar="DIR", help="Content-addressed store for --dedup values")
 optparser.add_option("-u", "--unique", action="store_true", default=False, help="Drop duplicate items")
 optparser.add_option("--noclean", dest="clean", default=True, action="store_false", help="Do not clean values of newlines and non-BMP Unicode")
 
@@ -270,8 +539,6 @@ optparser.add_option("--noclean", dest="clean", default=True, action="store_fals
 
 # Eventually this will take options indicating tab vs. json, or it will just take json
 
-items = list(jsonItemReader(infile))
-
 def uniquify (items):
     seen = set()
     dropped = 0
@@ -285,31 +552,88 @@ def uniquify (items):
     if dropped:
         print >>sys.stderr, "Dropped %d duplicate itemIDs" % dropped
 
-if options.unique:
-    items = list(uniquify(items))
+goldIDs = goldIndex.read(options.gold) if options.gold else None
+
+if options.seed is not None:
+    random.seed(options.seed)
 
-if False and options.clean:
-    items = cleanValues(items)
+if args:
+    # A named file is indexed in one pass, then read an item at a time as it is bundled,
+    # so only one bundle's content is in memory
+    items, gold = indexItems(jsonItemFile(infile), unique=options.unique, gold=goldIDs)
+else:
+    items = jsonItemReader(infile)
+    if options.unique:
+        items = uniquify(items)
+    if False and options.clean:
+        items = cleanValues(items)
+    if goldIDs is not None:
+        gold, items = separateGold(items, goldIDs)
+    else:
+        items = list(items)
+        gold = []
 
 if options.gold:
-    with open(options.gold) as f:
-        itemIDs = set(i.split()[0] for i in f)
-    gold, items = separateGold(items, itemIDs)
     if not options.random:
         print >>sys.stderr, "--random not specified, gold items will be in predictable positions"
-    goldRate = computeGoldRate(options.goldrate, options.n)
+    # With --tiers, each tier has its own rate
+    goldRate = None if options.tiers else computeGoldRate(options.goldrate, options.n)
 else:
-    gold = []
     goldRate = 0.0
     
-bundler = itemBundler(items, options.n,
-                      randomize=options.random,
-                      controlItems=gold,
-                      controlRate=goldRate,
-                      verbose=options.verbose)
-
-writeBundles(options.output or sys.stdout, bundler,
-             jsonize=set("%s_%d" % combo for combo in itertools.product(options.jsonize, range(1, options.n + 1))),
-             htmlize=set("%s_%d" % combo for combo in itertools.product(options.htmlize, range(1, options.n + 1))))
+def writeBatch (items, goldRate, output, store=None):
+    bundler = itemBundler(items, options.n,
+                          randomize=options.random,
+                          controlItems=gold,
+                          controlRate=goldRate,
+                          verbose=options.verbose)
+
+    bundles = bundler
+    jsonize = set("%s_%d" % combo for combo in itertools.product(options.jsonize, range(1, options.n + 1)))
+    htmlize = set("%s_%d" % combo for combo in itertools.product(options.htmlize, range(1, options.n + 1)))
+    if options.dedup:
+        assert store, "--dedup requires --blobs"
+        dedup = ["%s_%d" % combo for combo in itertools.product(options.dedup, range(1, options.n + 1))]
+        bundles = dedupBundles(bundler, store,
+                               dict((key, encode or plainEncode)
+                                    for key, encode in zip(dedup, columnEncoders(dedup, jsonize=jsonize, htmlize=htmlize))))
+        # The digests themselves are written plain
+        jsonize, htmlize = jsonize.difference(dedup), htmlize.difference(dedup)
+
+    writeBundles(output, bundles, keys=bundler.header(), jsonize=jsonize, htmlize=htmlize)
+    return bundler
+
+blobs = options.blobs and blobstore.blobStore(options.blobs)
+
+if options.tiers:
+    # One batch per tier of worker accuracy, each with its own gold rate, and a list of
+    # the tier's workers to target it with a qualification.  Items are shared out in
+    # proportion to the tier's past volume of work.
+    assert options.gold and options.accuracy and options.output, "--tiers requires --gold, --accuracy and --output"
+    tiers = planTiers(options.tiers, readWorkerAccuracy(options.accuracy), options.n)
+    if options.random:
+        shuffleItems(items)
+    base, extension = os.path.splitext(options.output)
+    slots = controlSlots = 0
+    # A tier no known worker reaches gets no batch; the last is kept for new workers
+    shares = [share if tierWorkers or t == len(tiers) - 1 else 0.0
+              for t, (minAccuracy, tierGoldRate, tierWorkers, share) in enumerate(tiers)]
+    for t, ((minAccuracy, tierGoldRate, tierWorkers, share), tierItems) in enumerate(zip(tiers, splitItems(items, shares))):
+        if not shares[t] and t < len(tiers) - 1:
+            print >>sys.stderr, "Tier %d: accuracy >= %g has no workers, skipping it" % (t + 1, minAccuracy)
+            continue
+        tierName = "%s.tier%d" % (base, t + 1)
+        print >>sys.stderr, "Tier %d: accuracy >= %g, %d workers, %.1f%% of past volume, %d items, gold rate %.3f" % (
+            t + 1, minAccuracy, len(tierWorkers), 100 * share, len(tierItems), tierGoldRate)
+        bundler = writeBatch(tierItems, tierGoldRate, tierName + extension, store=blobs)
+        with open(tierName + ".workers", "w") as f:
+            for workerID in tierWorkers:
+                print >>f, workerID
+        slots += bundler.nBundles * options.n
+        controlSlots += bundler.nControlSlots
+    print >>sys.stderr, "%d of %d slots (%.1f%%) are gold, against %.1f%% at the last tier's rate for everyone" % (
+        controlSlots, slots, 100 * controlSlots / (slots or 1), 100 * tiers[-1][1])
+else:
+    writeBatch(items, goldRate, options.output or sys.stdout, store=blobs)
 
 ######################################################################
@@ -0,0 +1,166 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sys
+import os
+import json
+import array
+import hashlib
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+A simple columnar store for unbundled responses.
+
+A store is a directory with a columns.json header, and two files per column:
+NNN.codes holds one 32-bit integer per row, and NNN.values holds the
+distinct values of the column, one JSON value per line, in code order.
+A code of -1 means the row has no value for that column.
+
+Written by unbundle-hits.py --store or store-responses.py, and read by
+naive-bayes.py and simple-score.py --store, which can then load just the
+columns they need without parsing any JSON or CSV rows.  With NumPy the
+code files are memory-mapped read-only, so several processes scoring the
+same store share one copy in the page cache.
+"""
+
+######################################################################
+
+storeFormat = "hybrid-curation-columns"
+
+class columnStoreWriter:
+    """Writes rows (dicts) to a store directory as they arrive.
+    Distinct values are remembered by digest, so large values are not held in memory."""
+
+    bufferRows = 4096
+
+    def __init__ (self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.columns = {}       # Maps name to [index, codes file, values file, {digest: code}, buffered codes]
+        self.names = []
+        self.rows = 0
+        self.flushed = 0        # Rows already in the code files; the rest are buffered
+
+    def addColumn (self, name):
+        index = len(self.names)
+        codes = open(os.path.join(self.path, "%03d.codes" % index), "wb")
+        values = open(os.path.join(self.path, "%03d.values" % index), "wb")
+        # Rows before this column appeared have no value for it.  The other
+        # columns may be partway through the current row, so they are not flushed
+        array.array("i", [-1] * self.flushed).tofile(codes)
+        buffered = array.array("i", [-1] * (self.rows - self.flushed))
+        self.columns[name] = column = [index, codes, values, {}, buffered]
+        self.names.append(name)
+        return column
+
+    def write (self, row):
+        columns = self.columns
+        for name in self.names:
+            columns[name][4].append(-1)
+        for name, value in row.iteritems():
+            column = columns.get(name)
+            if column is None:
+                column = self.addColumn(name)
+                column[4].append(-1)
+            encoded = json.dumps(value, sort_keys=True)
+            digest = hashlib.md5(encoded).digest()
+            code = column[3].get(digest)
+            if code is None:
+                code = column[3][digest] = len(column[3])
+                print >>column[2], encoded
+            column[4][-1] = code
+        self.rows += 1
+        if not self.rows % self.bufferRows:
+            self.flush()
+
+    def flush (self):
+        for column in self.columns.itervalues():
+            column[4].tofile(column[1])
+            del column[4][:]
+        self.flushed = self.rows
+
+    def writeAll (self, source):
+        for row in source:
+            self.write(row)
+        self.close()
+
+    def close (self):
+        self.flush()
+        for index, codeFile, valueFile, distinct, buffered in self.columns.itervalues():
+            codeFile.close()
+            valueFile.close()
+        header = dict(format=storeFormat, version=1, rows=self.rows, byteorder=sys.byteorder,
+                      columns=[dict(name=name, codes="%03d.codes" % self.columns[name][0],
+                                    values="%03d.values" % self.columns[name][0],
+                                    distinct=len(self.columns[name][3]))
+                               for name in self.names])
+        with open(os.path.join(self.path, "columns.json"), "w") as f:
+            json.dump(header, f, indent=1, sort_keys=True)
+        print >>sys.stderr, "%s: Wrote %d rows, %d columns to %s" % (self, self.rows, len(self.names), self.path)
+
+class columnStore:
+    """Reads a store directory, one column at a time"""
+
+    def __init__ (self, path):
+        self.path = path
+        with open(os.path.join(path, "columns.json")) as f:
+            header = json.load(f)
+        assert header.get("format") == storeFormat, "%s is not a column store" % path
+        assert header["byteorder"] == sys.byteorder, "%s was written with %s byte order" % (path, header["byteorder"])
+        self.rows = header["rows"]
+        self.columns = dict((c["name"], c) for c in header["columns"])
+
+    def __len__ (self):
+        return self.rows
+
+    def __contains__ (self, name):
+        return name in self.columns
+
+    def codes (self, name):
+        """The code of each row, -1 where there is no value.
+        With NumPy this is a read-only memory map rather than a copy."""
+        path = os.path.join(self.path, self.columns[name]["codes"])
+        if numpy is not None:
+            if not self.rows:
+                return numpy.zeros(0, dtype=numpy.intc)
+            return numpy.memmap(path, dtype=numpy.intc, mode="r", shape=(self.rows,))
+        codes = array.array("i")
+        with open(path, "rb") as f:
+            codes.fromfile(f, self.rows)
+        return codes
+
+    def values (self, name):
+        """The distinct values, in code order"""
+        with open(os.path.join(self.path, self.columns[name]["values"]), "rb") as f:
+            return [json.loads(line) for line in f]
+
+    def rowDicts (self, names, chunk=65536):
+        """Rows as dicts, with just the named columns"""
+        names = [name for name in names if name in self.columns]
+        columns = [(name, self.codes(name), self.values(name)) for name in names]
+        for start in xrange(0, self.rows, chunk):
+            # Plain ints a chunk at a time, so mapped columns are never copied whole
+            chunks = [(name, codes[start:start + chunk].tolist(), values) for name, codes, values in columns]
+            for i in xrange(min(chunk, self.rows - start)):
+                row = {}
+                for name, codes, values in chunks:
+                    code = codes[i]
+                    if code >= 0:
+                        row[name] = values[code]
+                yield row
+
+######################################################################
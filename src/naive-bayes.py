@@ -18,10 +18,20 @@ import optparse
 import sys, warnings, types, time
 import fileinput
 import collections
+import itertools
 import json
 import string
+import copy
+import os
+import array
+import hashlib
 # import sqlite3
 import math
+import columnstore
+try:
+    import numpy
+except ImportError:
+    numpy = None    # Needed for --numpy, --classes, --em and --state; --store uses it when present
 
 """
 An aggregator for multiple Turker responses that uses Naive Bayes.
@@ -33,7 +43,8 @@ a score for each candidate answer.
 
 The result is a stripped-down version of the JSON format of the input.
 
-Currently only works for boolean tasks.
+Works for boolean tasks by default; with --classes (and NumPy) it handles
+any number of answer labels, using a confusion matrix for each Turker.
 """
 
 ######################################################################
@@ -72,6 +83,26 @@ def writeJSON (file, source):
 def logistic (x):
     return 1.0 / (1.0 + math.exp(-x))
 
+class codeBook:
+    """Interns strings as consecutive integer codes"""
+
+    def __init__ (self, values=()):
+        self.codes = {}
+        self.values = []
+        for value in values:
+            self.code(value)
+
+    def code (self, value):
+        codes = self.codes
+        if value in codes:
+            return codes[value]
+        codes[value] = c = len(self.values)
+        self.values.append(value)
+        return c
+
+    def __len__ (self):
+        return len(self.values)
+
 ######################################################################
 #
 # Readers
@@ -84,7 +115,19 @@ def readList (file):
             s.append(line[0])
     return s                
 
-def readKeys (file, yes="yes"):
+def batchDigest (path):
+    """SHA-1 of a response file, or of a column store's files, to tell batches apart"""
+    digest = hashlib.sha1()
+    filenames = [path]
+    if os.path.isdir(path):
+        filenames = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), ""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def readKeys (file, yes="yes", classes=None):
     keys = {}
     nTotal = nKept = 0
     for item in csv.DictReader(maybeOpen(file, "r", None), dialect="excel-tab", fieldnames="itemID label".split()):
@@ -92,14 +135,17 @@ def readKeys (file, yes="yes"):
         if item["itemID"] in keys and keys[item["itemID"]] != item["label"]:
             print >>sys.stderr, "Conflicting entries in key for %s: %r -> %r" % (item["itemID"], keys[item["itemID"]], item["label"])
         k = item["label"].lower()
-        k = normalizeAnswer(k, yes=yes)
+        k = normalizeAnswer(k, yes=yes, classes=classes)
         keys[item["itemID"]] = k
     return keys
 
-def normalizeAnswer (answer, yes=None, missing=None):
-    """Special-case hackery, perhaps eventually more parameterized ..."""
+def normalizeAnswer (answer, yes=None, missing=None, classes=None):
+    """Special-case hackery, perhaps eventually more parameterized ...
+    With classes, answers are just lowercased; any not in classes are ignored later"""
     if answer in (None, ""):
         answer = missing
+    elif classes:
+        answer = answer.lower()
     # Special-case hackery ...
     elif answer.lower() == yes:
         answer = "yes"
@@ -107,15 +153,118 @@ def normalizeAnswer (answer, yes=None, missing=None):
         answer = "no"
     return answer
 
-def readResponses (file, itemref, answerref, yes="yes", missing=None):
-    """Group responses by itemID"""
-    responses = []
-    n = 0
+class responseColumns:
+    """Responses read in a single pass into compact columns of interned codes,
+    along with the summary counts, so they are never held as a list of tuples.
+    Iterating gives back (workerID, itemID, answer) tuples."""
+
+    def __init__ (self):
+        self.workers = codeBook()
+        self.items = codeBook()
+        self.answers = codeBook()
+        self.worker = array.array("i")
+        self.item = array.array("i")
+        self.answer = array.array("h")
+        self.nYes = self.nEmpty = self.nControl = self.nSkipped = 0
+        self.controlItems = set()
+
+    def __len__ (self):
+        return len(self.answer)
+
+    def __iter__ (self):
+        workers, items, answers = self.workers.values, self.items.values, self.answers.values
+        for w, i, a in itertools.izip(self.worker, self.item, self.answer):
+            yield workers[w], items[i], answers[a]
+
+def readResponses (file, itemref, answerref, yes="yes", missing=None, classes=None, itemIDs=None, controlIDs=()):
+    """Reads responses into responseColumns, keeping only itemIDs if given"""
+    responses = responseColumns()
+    workerCode, itemCode, answerCode = responses.workers.code, responses.items.code, responses.answers.code
+    appendWorker, appendItem, appendAnswer = responses.worker.append, responses.item.append, responses.answer.append
     for response in readJSON(file):
-        n += 1
-        # print  >>sys.stderr, n, r
-        r = normalizeAnswer(response.get(answerref), yes=yes, missing=missing)
-        responses.append((response["WorkerId"], response[itemref], r))
+        itemID = response[itemref]
+        if itemIDs and itemID not in itemIDs:
+            responses.nSkipped += 1
+            continue
+        r = normalizeAnswer(response.get(answerref), yes=yes, missing=missing, classes=classes)
+        if r == "yes":
+            responses.nYes += 1
+        elif r is None:
+            responses.nEmpty += 1
+        if itemID in controlIDs:
+            responses.nControl += 1
+            responses.controlItems.add(itemID)
+        appendWorker(workerCode(response["WorkerId"]))
+        appendItem(itemCode(itemID))
+        appendAnswer(answerCode(r))
+    return responses
+
+def readStoreResponses (path, itemref, answerref, yes="yes", missing=None, classes=None, itemIDs=None, controlIDs=()):
+    """Like readResponses, but from a column store: each distinct answer is normalized once,
+    and only integer codes are read per response (a whole column at a time with NumPy)"""
+    store = columnstore.columnStore(path)
+    responses = responseColumns()
+    workerValues = store.values("WorkerId")
+    itemValues = store.values(itemref)
+    answerValues = store.values(answerref) if answerref in store else []
+    # Items are interned up front (store values are in order of first appearance);
+    # workers and answers only once seen on a kept row, as readResponses does
+    itemMap = [responses.items.code(i) if not itemIDs or i in itemIDs else -1 for i in itemValues]
+    isControl = [i in controlIDs for i in itemValues]
+    # Answer code -1 (no value) falls through to the last entry
+    normalized = [normalizeAnswer(a, yes=yes, missing=missing, classes=classes) for a in answerValues + [None]]
+    workerMap = [-1] * len(workerValues)
+    answerMap = [-1] * len(normalized)
+    workerCodes = store.codes("WorkerId")
+    itemCodes = store.codes(itemref)
+    if answerref in store:
+        answerCodes = store.codes(answerref)
+    elif numpy is not None:
+        answerCodes = numpy.zeros(len(store), dtype=numpy.intc) - 1
+    else:
+        answerCodes = array.array("i", [-1] * len(store))
+    if numpy is not None:
+        # Rows with no item or worker (code -1) index the trailing False, and are skipped
+        kept = numpy.append(numpy.array(itemMap, dtype=numpy.intc) >= 0, False)[itemCodes] & (workerCodes >= 0)
+        items = itemCodes[kept]
+        workers = workerCodes[kept]
+        answers = answerCodes[kept] % len(normalized)
+        # Intern in order of first appearance, as readResponses does
+        for codeMap, values, codeBook, column in ((workerMap, workerValues, responses.workers, workers),
+                                                  (answerMap, normalized, responses.answers, answers)):
+            seen, first = numpy.unique(column, return_index=True)
+            for c in seen[numpy.argsort(first)]:
+                codeMap[c] = codeBook.code(values[c])
+        control = numpy.array(isControl, dtype=bool)[items]
+        responses.nSkipped = int(len(store) - len(items))
+        responses.nControl = int(control.sum())
+        controlCounts = numpy.bincount(items[control], minlength=len(itemValues))
+        responses.controlItems.update(itemValues[i] for i in numpy.flatnonzero(controlCounts))
+        responses.worker.fromstring(numpy.array(workerMap, dtype=numpy.intc)[workers].tostring())
+        responses.item.fromstring(numpy.array(itemMap, dtype=numpy.intc)[items].tostring())
+        responses.answer.fromstring(numpy.array(answerMap, dtype=numpy.short)[answers].tostring())
+        answerCounts = dict(enumerate(numpy.bincount(answers, minlength=len(normalized)).tolist()))
+    else:
+        appendWorker, appendItem, appendAnswer = responses.worker.append, responses.item.append, responses.answer.append
+        answerCounts = collections.defaultdict(int)
+        for w, i, a in itertools.izip(workerCodes, itemCodes, answerCodes):
+            item = itemMap[i] if i >= 0 and w >= 0 else -1
+            if item < 0:
+                responses.nSkipped += 1
+                continue
+            if isControl[i]:
+                responses.nControl += 1
+                responses.controlItems.add(itemValues[i])
+            if workerMap[w] < 0:
+                workerMap[w] = responses.workers.code(workerValues[w])
+            if answerMap[a] < 0:
+                answerMap[a] = responses.answers.code(normalized[a])
+            appendWorker(workerMap[w])
+            appendItem(item)
+            appendAnswer(answerMap[a])
+            answerCounts[a] += 1
+    responses.nYes = sum(n for (a, n) in answerCounts.iteritems() if normalized[a] == "yes")
+    responses.nEmpty = sum(n for (a, n) in answerCounts.iteritems() if normalized[a] is None)
     return responses
 
 ######################################################################
@@ -140,7 +289,9 @@ def countCoocurrences (reference, responses):
 class logOddsNB:
 
     def __init__ (self, references, responses):
-        self.bayesFactors = self.computeBayesFactors(countCoocurrences(keys, responses))
+        self.accuracies = {}
+        self.responses = responses
+        self.bayesFactors = self.computeBayesFactors(countCoocurrences(references, responses))
 
     def computeBayesFactors (self, workerCounts):
         factors = {}
@@ -156,8 +307,16 @@ class logOddsNB:
             factorYes = ((a / (a + c)) / (b / (b + d)))
             factorNo = ((c / (a + c)) / (d / (b + d)))
             factors[workerID] = dict(yes=math.log(factorYes), no=math.log(factorNo))
+            # Balanced accuracy, from the same smoothed estimates
+            self.accuracies[workerID] = (a / (a + c) + d / (b + d)) / 2
         return factors
 
+    def workerRecords (self):
+        # Only counted when asked for, as it is another pass over the responses
+        workerCounts = collections.Counter(workerID for (workerID, itemID, answer) in self.responses)
+        for workerID, accuracy in sorted(self.accuracies.iteritems()):
+            yield {"record": "turker", "WorkerId": workerID, "accuracy": accuracy, "items": workerCounts[workerID]}
+
     def aggregateResponses (self, allResponses, logPrior=0.0):
         bayesFactors = self.bayesFactors
         nMissing = 0
@@ -178,6 +337,337 @@ class logOddsNB:
                               logistic(score)))                   
         return aggregate    
         
+class responseArrays:
+    """Responses as parallel NumPy columns of worker, item and answer codes.
+    Answers not among labels (e.g. missing) are coded -1."""
+
+    def __init__ (self, responses=None, labels=("no", "yes")):
+        """responses is a responseColumns, whose ID codes are shared rather than copied"""
+        self.labels = list(labels)
+        if responses is None:
+            self.workers = codeBook()
+            self.items = codeBook()
+            self.worker = numpy.zeros(0, dtype=numpy.intc)
+            self.item = numpy.zeros(0, dtype=numpy.intc)
+            self.answer = numpy.zeros(0, dtype=numpy.int8)
+        else:
+            self.workers = responses.workers
+            self.items = responses.items
+            self.worker = numpy.frombuffer(responses.worker, dtype=numpy.intc)
+            self.item = numpy.frombuffer(responses.item, dtype=numpy.intc)
+            labelCodes = dict((label, i) for (i, label) in enumerate(self.labels))
+            answerLabels = numpy.array([labelCodes.get(a, -1) for a in responses.answers.values], dtype=numpy.int8)
+            self.answer = answerLabels[numpy.frombuffer(responses.answer, dtype=numpy.int16)]
+
+    def extend (self, other):
+        """Appends the responses of another responseArrays, recoding its IDs into these codes"""
+        assert other.labels == self.labels
+        workerCodes = numpy.array([self.workers.code(w) for w in other.workers.values], dtype=numpy.intc)
+        itemCodes = numpy.array([self.items.code(i) for i in other.items.values], dtype=numpy.intc)
+        if len(other):
+            self.worker = numpy.concatenate((self.worker, workerCodes[other.worker]))
+            self.item = numpy.concatenate((self.item, itemCodes[other.item]))
+            self.answer = numpy.concatenate((self.answer, other.answer))
+
+    def __len__ (self):
+        return len(self.answer)
+
+    def part (self, start, end=None):
+        """The responses from index start up to end, sharing these codes"""
+        part = copy.copy(self)
+        part.worker, part.item, part.answer = self.worker[start:end], self.item[start:end], self.answer[start:end]
+        return part
+
+    def itemLabels (self, reference):
+        """Reference label code for each item code, -1 if the item is not in the reference"""
+        labelCodes = dict((label, i) for (i, label) in enumerate(self.labels))
+        return numpy.array([labelCodes.get(reference.get(itemID), -1) for itemID in self.items.values],
+                           dtype=numpy.int8)
+
+class confusionNB:
+    """K-class Naive Bayes over responseArrays.
+    Each worker gets a KxK confusion matrix estimated against the key in a single pass,
+    and all classes are scored at once."""
+
+    def __init__ (self, references, responses):
+        self.responses = responses
+        self.labels = responses.labels
+        counts, self.hasFactors = self.countConfusions(references)
+        self.logLikelihoods = self.computeLogLikelihoods(counts)
+
+    def countConfusions (self, reference, start=0):
+        """Returns counts[worker, ref, answer] and a mask of workers with any keyed responses,
+        counting only responses from index start on"""
+        r = self.responses
+        nWorkers, k = len(r.workers), len(self.labels)
+        r = r.part(start)
+        refs = r.itemLabels(reference)[r.item]
+        keyed = refs >= 0
+        pairs = r.worker[keyed].astype(numpy.int64) * len(r.items) + r.item[keyed]
+        dups = len(pairs) - len(numpy.unique(pairs))
+        if dups:
+            print >>sys.stderr, "%d worker-item duplicates" % dups
+        seen = numpy.bincount(r.worker[keyed], minlength=nWorkers) > 0
+        both = keyed & (r.answer >= 0)
+        counts = numpy.bincount((r.worker[both] * k + refs[both]) * k + r.answer[both], minlength=nWorkers * k * k)
+        return counts.reshape(nWorkers, k, k), seen
+
+    def computeLogLikelihoods (self, counts):
+        """Returns logLikelihoods[worker, ref, answer] = log P(answer | ref)"""
+        # Simplistic Laplace smoothing, as in the 2x2 case
+        counts = counts + 1.0
+        return numpy.log(counts / counts.sum(axis=2)[:, :, numpy.newaxis])
+
+    def scoreItems (self, r, logPrior):
+        """Returns (scores[item, class], codes of items with any usable responses)"""
+        valid = self.hasFactors[r.worker] & (r.answer >= 0)
+        nMissing = len(r) - int(valid.sum())
+        print >>sys.stderr, "%d responses ignored for lack of Bayes factors" % nMissing
+        items, workers, answers = r.item[valid], r.worker[valid], r.answer[valid]
+        scores = numpy.empty((len(r.items), len(self.labels)))
+        for c in xrange(len(self.labels)):
+            scores[:, c] = numpy.bincount(items, weights=self.logLikelihoods[workers, c, answers],
+                                          minlength=len(r.items))
+        scores += logPrior
+        return scores, numpy.flatnonzero(numpy.bincount(items, minlength=len(r.items)))
+
+    def aggregateResponses (self, allResponses=None, logPrior=0.0):
+        """Returns [(itemID, best label, its posterior, {label: posterior ...}) ...]
+        logPrior may be a single value or one log prior per class"""
+        r = allResponses or self.responses
+        assert r.workers is self.responses.workers, "Responses must share the worker codes used for the factors"
+        scores, scored = self.scoreItems(r, logPrior)
+        return self.summarize(r.items.values, scores, scored)
+
+    def workerRecords (self):
+        """Each worker's balanced accuracy (mean P(answer = ref | ref)) under the fitted estimates,
+        and number of responses, as records like simple-score.py --format json's"""
+        r = self.responses
+        accuracies = numpy.exp(numpy.diagonal(self.logLikelihoods, axis1=1, axis2=2)).mean(axis=1)
+        volumes = numpy.bincount(r.worker, minlength=len(r.workers))
+        for w in numpy.flatnonzero(self.hasFactors).tolist():
+            yield {"record": "turker", "WorkerId": r.workers.values[w], "accuracy": float(accuracies[w]), "items": int(volumes[w])}
+
+    def posteriors (self, scores):
+        posteriors = numpy.exp(scores - scores.max(axis=1)[:, numpy.newaxis])
+        posteriors /= posteriors.sum(axis=1)[:, numpy.newaxis]
+        return posteriors
+
+    def summarize (self, itemIDs, scores, scored):
+        posteriors = self.posteriors(scores[scored])
+        best = posteriors.argmax(axis=1)
+        labels = self.labels
+        return [(itemIDs[i], labels[b], p[b], dict(zip(labels, p)))
+                for (i, b, p) in zip(scored.tolist(), best.tolist(), posteriors.tolist())]
+
+class emNB (confusionNB):
+    """Dawid-Skene EM, starting from the keyed confusionNB estimates.
+    Worker confusion matrices are re-estimated from the item posteriors,
+    so workers who saw few or no controls still contribute.
+    Keyed items are held at their reference labels while fitting."""
+
+    def __init__ (self, references, responses, logPrior=0.0, tolerance=1e-4, maxIterations=50, maxSeconds=None):
+        confusionNB.__init__(self, references, responses)
+        self.fit(references, logPrior, tolerance, maxIterations, maxSeconds)
+
+    def fit (self, references, logPrior, tolerance, maxIterations, maxSeconds):
+        r = self.responses
+        nWorkers, nItems, k = len(r.workers), len(r.items), len(self.labels)
+        valid = r.answer >= 0
+        items, workers, answers = r.item[valid], r.worker[valid], r.answer[valid]
+        refs = r.itemLabels(references)
+        keyed = numpy.flatnonzero(refs >= 0)
+        clamp = numpy.zeros((len(keyed), k))
+        clamp[numpy.arange(len(keyed)), refs[keyed]] = 1.0
+        # Start from smoothed vote proportions, then the keyed Naive Bayes posteriors where there are any
+        votes = numpy.bincount(items * k + answers, minlength=nItems * k).reshape(nItems, k) + 1.0
+        posteriors = votes / votes.sum(axis=1)[:, numpy.newaxis]
+        scores, scored = self.scoreItems(r, logPrior)
+        posteriors[scored] = self.posteriors(scores[scored])
+        posteriors[keyed] = clamp
+        fitStart = time.time()
+        for iteration in xrange(1, maxIterations + 1):
+            iterStart = time.time()
+            # M step: expected confusion counts and class priors from the current posteriors
+            counts = numpy.empty((nWorkers, k, k))
+            for c in xrange(k):
+                counts[:, c, :] = numpy.bincount(workers * k + answers, weights=posteriors[items, c],
+                                                 minlength=nWorkers * k).reshape(nWorkers, k)
+            self.logLikelihoods = self.computeLogLikelihoods(counts)
+            classTotals = posteriors.sum(axis=0) + 1.0
+            self.logClassPrior = numpy.log(classTotals / classTotals.sum())
+            # E step
+            scores = numpy.empty((nItems, k))
+            for c in xrange(k):
+                scores[:, c] = numpy.bincount(items, weights=self.logLikelihoods[workers, c, answers], minlength=nItems)
+            newPosteriors = self.posteriors(scores + self.logClassPrior)
+            newPosteriors[keyed] = clamp
+            change = numpy.abs(newPosteriors - posteriors).max()
+            posteriors = newPosteriors
+            print >>sys.stderr, "EM iteration %d: max change %.6f (%.2fs)" % (iteration, change, time.time() - iterStart)
+            if change < tolerance:
+                print >>sys.stderr, "EM converged after %d iterations (%.2fs)" % (iteration, time.time() - fitStart)
+                break
+            if maxSeconds and time.time() - fitStart > maxSeconds:
+                print >>sys.stderr, "EM stopped at time limit after %d iterations (%.2fs)" % (iteration, time.time() - fitStart)
+                break
+        else:
+            print >>sys.stderr, "EM did not converge in %d iterations (%.2fs)" % (maxIterations, time.time() - fitStart)
+        # Every worker now has estimates
+        self.hasFactors = numpy.ones(nWorkers, dtype=bool)
+
+    def aggregateResponses (self, allResponses=None, logPrior=None):
+        return confusionNB.aggregateResponses(self, allResponses,
+                                              self.logClassPrior if logPrior is None else logPrior)
+
+class incrementalNB (confusionNB):
+    """confusionNB with state that persists between runs.
+    The state is just the per-worker confusion counts and the per-item score sums,
+    so each run costs in proportion to the new responses.  New responses are scored
+    with the estimates as updated by them; earlier ones keep the estimates they were
+    added with and are never revised, so the scores are an approximation that drifts
+    from a full run over all the responses as batches accumulate (run without --state
+    to re-score everything with the final estimates).
+    The batches added so far are remembered by digest, so none is counted twice."""
+
+    stateArrays = "workerIDs itemIDs labels counts seen workerVolumes classCounts itemRefs itemScores itemCounts batches".split()
+
+    def __init__ (self, labels):
+        self.labels = list(labels)
+        self.responses = responseArrays(labels=labels)     # Just the code books, and the responses being added
+        k = len(labels)
+        self.counts = numpy.zeros((0, k, k))
+        self.seen = numpy.zeros(0, dtype=bool)
+        self.workerVolumes = numpy.zeros(0, dtype=numpy.int64)
+        self.classCounts = numpy.zeros(k, dtype=numpy.int64)
+        self.itemRefs = numpy.zeros(0, dtype=numpy.int8)
+        self.itemScores = numpy.zeros((0, k))
+        self.itemCounts = numpy.zeros(0, dtype=numpy.int64)
+        self.batches = []
+        self.logLikelihoods = self.hasFactors = None
+
+    @classmethod
+    def load (cls, file, labels):
+        with open(file, "rb") as f:
+            state = numpy.load(f, allow_pickle=False)
+            assert set(cls.stateArrays).issubset(state.files), "%s is not a state file for this version" % file
+            state = dict((name, state[name]) for name in cls.stateArrays)
+        assert list(state["labels"]) == list(labels), "State file %s has labels %s" % (file, " ".join(state["labels"]))
+        self = cls(labels)
+        r = self.responses
+        r.workers = codeBook(state["workerIDs"].tolist())
+        r.items = codeBook(state["itemIDs"].tolist())
+        for name in "counts seen workerVolumes classCounts itemRefs itemScores itemCounts".split():
+            setattr(self, name, state[name])
+        self.batches = state["batches"].tolist()
+        self.estimate()
+        print >>sys.stderr, "Loaded state from %s: %d batches, %d responses, %d workers, %d items" % (
+            file, len(self.batches), self.workerVolumes.sum(), len(r.workers), len(r.items))
+        return self
+
+    def save (self, file):
+        r = self.responses
+        state = dict(workerIDs=numpy.array(r.workers.values, dtype=unicode),
+                     itemIDs=numpy.array(r.items.values, dtype=unicode),
+                     labels=numpy.array(self.labels, dtype=unicode),
+                     counts=self.counts, seen=self.seen, workerVolumes=self.workerVolumes,
+                     classCounts=self.classCounts, itemRefs=self.itemRefs,
+                     itemScores=self.itemScores, itemCounts=self.itemCounts,
+                     batches=numpy.array(self.batches, dtype=str))
+        # Write and rename, so an interrupted run leaves the old state intact
+        with open(file + ".tmp", "wb") as f:
+            numpy.savez(f, **state)
+        os.rename(file + ".tmp", file)
+
+    def estimate (self):
+        # Workers without controls contribute nothing, as in confusionNB
+        self.logLikelihoods = self.computeLogLikelihoods(self.counts) * self.seen[:, numpy.newaxis, numpy.newaxis]
+        self.hasFactors = self.seen
+
+    def update (self, references, newResponses, batches=()):
+        """Adds newResponses (a responseColumns) from the given batch digests"""
+        r = self.responses
+        r.extend(responseArrays(newResponses, labels=self.labels))
+        nWorkers, nItems, k = len(r.workers), len(r.items), len(self.labels)
+        print >>sys.stderr, "Adding %d responses (%d workers, %d items in all)" % (len(r), nWorkers, nItems)
+        # Pad the per-worker and per-item state for new codes
+        oldWorkers, oldItems = len(self.seen), len(self.itemRefs)
+        self.counts = numpy.concatenate((self.counts, numpy.zeros((nWorkers - oldWorkers, k, k))))
+        self.seen = numpy.concatenate((self.seen, numpy.zeros(nWorkers - oldWorkers, dtype=bool)))
+        self.workerVolumes = numpy.concatenate((self.workerVolumes, numpy.zeros(nWorkers - oldWorkers, dtype=numpy.int64)))
+        self.itemScores = numpy.concatenate((self.itemScores, numpy.zeros((nItems - oldItems, k))))
+        self.itemCounts = numpy.concatenate((self.itemCounts, numpy.zeros(nItems - oldItems, dtype=numpy.int64)))
+        itemRefs = r.itemLabels(references)
+        # Earlier responses were counted under the old key, and are not kept to recount
+        changed = (self.itemRefs >= 0) & (itemRefs[:oldItems] != self.itemRefs)
+        assert not changed.any(), "Key has changed for %d items since the state was saved, rebuild it from all responses" % changed.sum()
+        added = (self.itemRefs < 0) & (itemRefs[:oldItems] >= 0)
+        if added.any():
+            print >>sys.stderr, "%d earlier items are newly keyed, only their new responses count as controls" % added.sum()
+        self.itemRefs = itemRefs
+        counts, seen = self.countConfusions(references)
+        self.counts += counts
+        self.seen |= seen
+        self.workerVolumes += numpy.bincount(r.worker, minlength=nWorkers)
+        self.classCounts += numpy.bincount(r.answer[r.answer >= 0], minlength=k)
+        self.estimate()
+        valid = self.seen[r.worker] & (r.answer >= 0)
+        print >>sys.stderr, "%d new responses ignored for lack of Bayes factors" % (len(r) - valid.sum())
+        items, workers, answers = r.item[valid], r.worker[valid], r.answer[valid]
+        for c in xrange(k):
+            self.itemScores[:, c] += numpy.bincount(items, weights=self.logLikelihoods[workers, c, answers], minlength=nItems)
+        self.itemCounts += numpy.bincount(items, minlength=nItems)
+        self.batches.extend(batches)
+        # Only the counts are kept
+        self.responses = r.part(0, 0)
+
+    def workerRecords (self):
+        accuracies = numpy.exp(numpy.diagonal(self.logLikelihoods, axis1=1, axis2=2)).mean(axis=1)
+        for w in numpy.flatnonzero(self.hasFactors).tolist():
+            yield {"record": "turker", "WorkerId": self.responses.workers.values[w], "accuracy": float(accuracies[w]),
+                   "items": int(self.workerVolumes[w])}
+
+    def aggregateResponses (self, allResponses=None, logPrior=0.0):
+        assert allResponses is None, "Aggregates come from the saved sums"
+        return self.summarize(self.responses.items.values, self.itemScores + logPrior,
+                              numpy.flatnonzero(self.itemCounts))
+
+class arrayLogOddsNB (confusionNB):
+    """Same model as logOddsNB, computed with scatter-adds over integer-coded responseArrays.
+    This is the two-class case of confusionNB, reporting log-odds of "yes"."""
+
+    def __init__ (self, references, responses):
+        assert responses.labels == ["no", "yes"]
+        self.responses = responses
+        self.labels = responses.labels
+        counts, self.hasFactors = self.countConfusions(references)
+        self.bayesFactors = self.computeBayesFactors(counts)
+        self.logLikelihoods = self.computeLogLikelihoods(counts)
+
+    def computeBayesFactors (self, counts):
+        """Returns factors[worker, answer]"""
+        # Contingency table, with simplistic Laplace smoothing
+        counts = counts + 1.0
+        a, b, c, d = counts[:, 1, 1], counts[:, 0, 1], counts[:, 1, 0], counts[:, 0, 0]
+        factorYes = numpy.log((a / (a + c)) / (b / (b + d)))
+        factorNo = numpy.log((c / (a + c)) / (d / (b + d)))
+        return numpy.column_stack((factorNo, factorYes))
+
+    def aggregateResponses (self, allResponses=None, logPrior=0.0):
+        r = allResponses or self.responses
+        assert r.workers is self.responses.workers, "Responses must share the worker codes used for the factors"
+        valid = self.hasFactors[r.worker] & (r.answer >= 0)
+        nMissing = len(r) - int(valid.sum())
+        print >>sys.stderr, "%d responses ignored for lack of Bayes factors" % nMissing
+        items = r.item[valid]
+        scores = numpy.bincount(items, weights=self.bayesFactors[r.worker[valid], r.answer[valid]],
+                                minlength=len(r.items)) + logPrior
+        scored = numpy.flatnonzero(numpy.bincount(items, minlength=len(r.items)))
+        probs = 1.0 / (1.0 + numpy.exp(-scores[scored]))
+        itemIDs = r.items.values
+        return [(itemIDs[i], "yes" if scores[i] > 0 else "no", p)
+                for (i, p) in zip(scored.tolist(), probs.tolist())]
+
 ######################################################################
 #
 # Options
@@ -191,6 +681,9 @@ optparser.add_option("-v", "--verbose", action="count", help = "More verbose out
 # optParser.add_option("--references", default="referenceAnswers", help="Reference table to use")
 
 optparser.add_option("-k", "--key", help="tab-delim key file", metavar="TSVFILE")
+optparser.add_option("--store", metavar="DIR", help="Read responses from a column store written by unbundle-hits.py --store")
+optparser.add_option("--workers", metavar="FILE",
+                     help="Write each worker's estimated accuracy and number of responses to FILE as JSON records")
 optparser.add_option("--itemids", help="Item IDs to include (all by default)", metavar="FLATFILE")
 # optparser.add_option("--meta", help="Meta-annotation batch", metavar="JSONFILE")
 # Is this necessary, given KEYS?
@@ -200,20 +693,39 @@ optparser.add_option("--answerref", metavar="NAME", default="Answer.answer", hel
 optparser.add_option("--yes", metavar="VALUE", default="yes",
                      help='''Interpret VALUE as "yes" label, all others as "no" (default %default)''')
 optparser.add_option("--missing", metavar="VALUE", default=None, help="Use VALUE for missing answers (default is to skip them)")
-optparser.add_option("--logprior", metavar="LOGIT",type=float, default=0.0, help="Use LOGIT as the prior in the Naive Bayes summation (default %default))")
+optparser.add_option("--logprior", metavar="LOGIT",type=float, default=0.0, help="Use LOGIT as the prior log-odds of \"yes\" in the Naive Bayes summation, not with --classes (default %default)")
 optparser.add_option("--empirical", action="store_true", help="Compute prior from the data (gasp)")
+optparser.add_option("--numpy", action="store_true", help="Use the array-backed engine (requires NumPy)")
+optparser.add_option("--classes", metavar="LABELS",
+                     help="Multi-class mode: LABELS is a list of answer labels, scored all at once (requires NumPy)")
+optparser.add_option("--em", action="store_true",
+                     help="Re-estimate Turker confusion from the item posteriors with EM (Dawid-Skene), requires NumPy")
+optparser.add_option("--tolerance", metavar="DELTA", type=float, default=1e-4,
+                     help="EM stops when no posterior changes by more than DELTA (default %default)")
+optparser.add_option("--maxiter", metavar="N", type=int, default=50, help="At most N EM iterations (default %default)")
+optparser.add_option("--maxtime", metavar="SECONDS", type=float, default=None, help="Stop EM after SECONDS")
+optparser.add_option("--state", metavar="NPZFILE",
+                     help="Keep worker counts and item sums in NPZFILE, adding just the response files (or --store) not already in it (requires NumPy).  "
+                     "Earlier responses keep the estimates they were added with, so scores approximate, and drift from, a full run without --state")
 
 # optParser.add_option("--db", help = "Database file")
 
 (options, files) = optparser.parse_args()
+classes = options.classes and options.classes.lower().split()
 
 ######################################################################
 #
 # Main
 
+assert not (classes and options.logprior), "--logprior is a yes/no log-odds, use --empirical for class priors with --classes"
+
 if options.key:
-    keys = readKeys(options.key, yes=options.yes)
-    print >>sys.stderr, '''Read %d keys (%d "yes")''' % (len(keys), sum(1 for k in keys.itervalues() if k == "yes"))
+    keys = readKeys(options.key, yes=options.yes, classes=classes)
+    if classes:
+        keyCounts = collections.Counter(keys.itervalues())
+        print >>sys.stderr, "Read %d keys (%s)" % (len(keys), " ".join("%s=%d" % (c, keyCounts[c]) for c in classes))
+    else:
+        print >>sys.stderr, '''Read %d keys (%d "yes")''' % (len(keys), sum(1 for k in keys.itervalues() if k == "yes"))
 else:
     keys = {}
 
@@ -234,22 +746,101 @@ if options.itemids:
 else:
     itemIDs = set()
 
-responses = readResponses(fileinput.input(files), options.itemref, options.answerref, yes=options.yes, missing=options.missing)
-print >>sys.stderr, '''Read %d responses (%d items, %d "yes", %d empty)''' % (len(responses), len(set(i for (w, i, r) in responses)),
-                                                                              sum(1 for (w, i, r) in responses if r =="yes"),
-                                                                              sum(1 for (w, i, r) in responses if r == None))
-
-nb = logOddsNB(keys, responses)
-logPrior = options.logprior
-if options.empirical:
-    logPrior = (math.log(sum(1 for (w, i, r) in responses if r =="yes"))
-                - math.log(sum(1 for (w, i, r) in responses if r != "yes")))
-    print >>sys.stderr, "Using empirical log-odds from responses - %.4f (%.3f)" % (logPrior, math.exp(logPrior))
-nbAggregate = nb.aggregateResponses(responses, logPrior=logPrior)
-nbAggregate.sort(key=lambda (i,a,s): s, reverse=True)
-for itemID, answer, score in nbAggregate:
-    print >>sys.stdout, json.dumps({"WorkerId": "NaiveBayes", options.itemref: itemID,
-                                    options.answerref: answer, "Answer.score": score},
-                                   sort_keys=True)
+if options.state:
+    # Only batches not already in the state are read, so each is counted once
+    assert numpy, "--state requires the numpy package"
+    assert not options.em, "--em cannot be used with --state"
+    assert (options.store or files) and "-" not in files, "--state requires named response files or --store"
+    if os.path.exists(options.state):
+        nb = incrementalNB.load(options.state, classes or ["no", "yes"])
+    else:
+        print >>sys.stderr, "Starting new state in %s" % options.state
+        nb = incrementalNB(classes or ["no", "yes"])
+    batches = collections.OrderedDict()
+    for path in [options.store] if options.store else files:
+        digest = batchDigest(path)
+        if digest in nb.batches or digest in batches:
+            print >>sys.stderr, "Skipping %s, already added" % path
+        else:
+            batches[digest] = path
+    if options.store and not batches:
+        options.store = None
+    files = batches.values()
+
+if options.state and not batches:
+    responses = responseColumns()
+elif options.store:
+    responses = readStoreResponses(options.store, options.itemref, options.answerref,
+                                   yes=options.yes, missing=options.missing, classes=classes,
+                                   itemIDs=itemIDs, controlIDs=controlIDs)
+else:
+    responses = readResponses(fileinput.input(files), options.itemref, options.answerref,
+                              yes=options.yes, missing=options.missing, classes=classes,
+                              itemIDs=itemIDs, controlIDs=controlIDs)
+print >>sys.stderr, '''Read %d responses (%d items, %d "yes", %d empty)''' % (len(responses), len(responses.items),
+                                                                              responses.nYes, responses.nEmpty)
+if responses.nSkipped:
+    print >>sys.stderr, "Skipped %d responses for other item IDs, or with no item or worker" % responses.nSkipped
+print >>sys.stderr, "%d responses to %d control items" % (responses.nControl, len(responses.controlItems))
+
+if classes or options.em or options.state:
+    assert numpy, "--classes, --em and --state require the numpy package"
+    labels = classes or ["no", "yes"]
+    if options.state:
+        nb.update(keys, responses, batches)
+        nb.save(options.state)
+        classCounts = nb.classCounts
+    else:
+        responses = responseArrays(responses, labels=labels)
+        classCounts = numpy.bincount(responses.answer[responses.answer >= 0], minlength=len(labels))
+    print >>sys.stderr, "Class counts: %s" % " ".join("%s=%d" % lc for lc in zip(labels, classCounts))
+    logPrior = 0.0 if classes else numpy.array([0.0, options.logprior])
+    if options.empirical:
+        logPrior = numpy.log((classCounts + 1.0) / (classCounts.sum() + len(labels)))
+        print >>sys.stderr, "Using empirical class log-priors from responses - %s" % " ".join("%s=%.4f" % lp for lp in zip(labels, logPrior))
+    if options.state:
+        nbAggregate = nb.aggregateResponses(logPrior=logPrior)
+    elif options.em:
+        # EM estimates its own class priors; logPrior only affects the starting point
+        nb = emNB(keys, responses, logPrior=logPrior,
+                  tolerance=options.tolerance, maxIterations=options.maxiter, maxSeconds=options.maxtime)
+        nbAggregate = nb.aggregateResponses()
+    else:
+        nb = confusionNB(keys, responses)
+        nbAggregate = nb.aggregateResponses(logPrior=logPrior)
+    if classes:
+        nbAggregate.sort(key=lambda (i,a,s,ss): s, reverse=True)
+        for itemID, answer, score, scores in nbAggregate:
+            print >>sys.stdout, json.dumps({"WorkerId": "NaiveBayes", options.itemref: itemID,
+                                            options.answerref: answer, "Answer.score": score, "Answer.scores": scores},
+                                           sort_keys=True)
+    else:
+        # Same output as the binary engines, with the score as P(yes)
+        nbAggregate.sort(key=lambda (i,a,s,ss): ss["yes"], reverse=True)
+        for itemID, answer, score, scores in nbAggregate:
+            print >>sys.stdout, json.dumps({"WorkerId": "NaiveBayes", options.itemref: itemID,
+                                            options.answerref: answer, "Answer.score": scores["yes"]},
+                                           sort_keys=True)
+else:
+    if options.numpy:
+        assert numpy, "--numpy requires the numpy package"
+        nb = arrayLogOddsNB(keys, responseArrays(responses))
+    else:
+        nb = logOddsNB(keys, responses)
+    logPrior = options.logprior
+    if options.empirical:
+        logPrior = math.log(responses.nYes) - math.log(len(responses) - responses.nYes)
+        print >>sys.stderr, "Using empirical log-odds from responses - %.4f (%.3f)" % (logPrior, math.exp(logPrior))
+    nbAggregate = nb.aggregateResponses(None if options.numpy else responses, logPrior=logPrior)
+    nbAggregate.sort(key=lambda (i,a,s): s, reverse=True)
+    for itemID, answer, score in nbAggregate:
+        print >>sys.stdout, json.dumps({"WorkerId": "NaiveBayes", options.itemref: itemID,
+                                        options.answerref: answer, "Answer.score": score},
+                                       sort_keys=True)
+
+if options.workers:
+    with open(options.workers, "w") as f:
+        for record in nb.workerRecords():
+            print >>f, json.dumps(record, sort_keys=True)
 
 ######################################################################
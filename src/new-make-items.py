@@ -13,12 +13,15 @@ limitations under the License.
 
 from __future__ import division
 import sys
+import re
 import optparse
 import fileinput
 import json
 import itertools
 import cgi
 import collections
+import multiprocessing
+import heapq
 
 ######################################################################
 
@@ -26,7 +29,7 @@ idRE = re.compile("^[\w~@#%^*-+/]{1,80}$")	# Mild security measure: Precribed le
 def readDocs (input):
     for line in input:
         doc = json.loads(line)
-        assert idRE.match(doc["id"]), "Bad ID format"
+        assert idRE.match(doc["docID"]), "Bad ID format"
         yield doc
 
 def planMarkup (annotations, tag, attributes, skipEmpties=True):
@@ -44,11 +47,15 @@ def planMarkup (annotations, tag, attributes, skipEmpties=True):
             yield dict(pos=s, offsets=(s, e), key=(s, 2, -e), id=tagID, tag=startTag, type="start")
             yield dict(pos=e, offsets=(s, e), key=(e, 1, -s), id=tagID, tag=endTag, type="end")
 
-def insertMarkup (content, markup):
-    markup.sort(key=lambda d: d["key"])
+def insertMarkup (content, markup, presorted=False):
+    """Builds the marked-up content in a single pass over a list of slices.
+    Pass presorted=True if the markup is already in key order."""
+    if not presorted:
+        markup = sorted(markup, key=lambda d: d["key"])
     # print >>sys.stderr, markup
-    result = ""
-    pos = lastPos = 0
+    result = []
+    append = result.append
+    lastPos = 0
     tagStack = []
     for tag in markup:
         pos = tag["pos"]
@@ -64,12 +71,19 @@ def insertMarkup (content, markup):
             tagStack.append(tag)
         # print >>sys.stderr, content[lastPos:min(lastPos + 20,pos)], "\n"
         # print >>sys.stderr, tag["tag"], "\n"
-        result += content[lastPos:pos]
-        result += tag["tag"]
+        append(content[lastPos:pos])
+        append(tag["tag"])
         lastPos = pos
-    result += content[lastPos:]
+    append(content[lastPos:])
     assert not tagStack
-    return result
+    return "".join(result)
+
+def sortedPlan (group, typeIndex):
+    """Plans the markup for one concept group, sorted and decorated for heapq.merge.
+    Entries are (key, typeIndex, seq, tag), so ties across groups fall in concept type order,
+    and ties within a group keep plan order, just as a stable sort of the concatenation would."""
+    plan = planMarkup(group, "annotation", dict(conceptID=group["conceptID"], conceptType=group["type"]))
+    return sorted((tag["key"], typeIndex, seq, tag) for (seq, tag) in enumerate(plan))
 
 def generateItems (doc, conceptTypes):
     docID = doc["docID"]
@@ -83,19 +97,50 @@ def generateItems (doc, conceptTypes):
     # This is a list of n lists, where n is the number of concept types, in the same order as conceptTypes
     allTypeGroups = [conceptGroups[ct] for ct in conceptTypes]
     # print >>sys.stderr, allTypeGroups
+    # planCache[(docID, type, conceptID)] => sorted plan, computed once no matter how many items use it
+    planCache = {}
+    def plan (typeIndex, group):
+        cacheKey = (docID, group["type"], group["conceptID"])
+        if cacheKey not in planCache:
+            planCache[cacheKey] = sortedPlan(group, typeIndex)
+        return planCache[cacheKey]
     for tuple in itertools.product(*allTypeGroups):	# Cross-product
         # Each tuple has one concept group per type
         # print >>sys.stderr, tuple
         concepts = dict((group["type"], dict(conceptID=group["conceptID"], gloss=group.get("gloss")))
                         for group in tuple)
         itemID = "-".join([docID] + [group["conceptID"] for group in tuple])
-        markup = list(itertools.chain.from_iterable(planMarkup(group, "annotation",
-                                                               dict(conceptID=group["conceptID"],
-                                                                    conceptType=group["type"]))
-                                                    for group in tuple))
+        # k-way merge of the already sorted plans
+        markup = [tag for (key, typeIndex, seq, tag) in heapq.merge(*[plan(i, group) for (i, group) in enumerate(tuple)])]
         # Have to deal with overlapping markup at some point
         yield dict(itemID=itemID, docID=docID, concepts=concepts,
-                   content=insertMarkup(doc["content"], markup))
+                   content=insertMarkup(doc["content"], markup, presorted=True))
+
+def docItemLines (line, conceptTypes):
+    """Worker for --jobs: one document's JSON line in, its items' JSON lines out"""
+    (doc, ) = readDocs([line])
+    return [json.dumps(i, sort_keys=True) for i in generateItems(doc, conceptTypes)]
+
+def parallelItemLines (lines, conceptTypes, jobs):
+    """Fans documents out to a process pool and yields item lines in input order.
+    At most a few documents per worker are in flight, so the parent never holds the full batch."""
+    pool = multiprocessing.Pool(jobs)
+    pending = collections.deque()
+    try:
+        for line in lines:
+            pending.append(pool.apply_async(docItemLines, (line, conceptTypes)))
+            if len(pending) >= 4 * jobs:
+                for itemLine in pending.popleft().get():
+                    yield itemLine
+        while pending:
+            for itemLine in pending.popleft().get():
+                yield itemLine
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 ######################################################################
 
@@ -103,6 +148,8 @@ optparser = optparse.OptionParser()
 optparser.set_usage("""Usage: %prog [options] [annfiles ...]""")
 
 optparser.add_option("--concepts", metavar="CONCEPTLIST", help="Each item will be a tuple of these comcept types")
+optparser.add_option("-j", "--jobs", metavar="N", type="int", default=1,
+                     help="Generate items with N worker processes, output order is unchanged (default %default)")
 
 (options, docFiles) = optparser.parse_args()
 assert docFiles
@@ -110,8 +157,15 @@ assert docFiles
 assert options.concepts
 conceptTypes = options.concepts.split()
 
-docs = readDocs(fileinput.input(docFiles))
-items = list(itertools.chain.from_iterable(generateItems(d, conceptTypes) for d in docs))
+if options.jobs > 1:
+    itemLines = parallelItemLines(fileinput.input(docFiles), conceptTypes, options.jobs)
+else:
+    docs = readDocs(fileinput.input(docFiles))
+    itemLines = (json.dumps(i, sort_keys=True)
+                 for i in itertools.chain.from_iterable(generateItems(d, conceptTypes) for d in docs))
+nItems = 0
+for line in itemLines:
+    print >>sys.stdout, line
+    nItems += 1
 
-for i in items:
-    print >>sys.stdout, json.dumps(i, sort_keys=True)
+print >>sys.stderr, "Generated %d items" % nItems
@@ -14,11 +14,13 @@ limitations under the License.
 from __future__ import division
 
 import sys
+import re
 import json
 import optparse
 import itertools
 import csv
 import collections
+import heapq
 
 ######################################################################
 
@@ -48,12 +50,17 @@ Each JSON dict looks like this:
 }
 
 (Note that the offset space includes any markup in the content.)
+
+With --sorted, each annotation file must already be sorted by docID,
+and documents are merged and written one at a time, so memory is bounded
+by the largest single document rather than the whole corpus.
 """
 
 ######################################################################
 
 idRE = re.compile("^[\w~@#%^*-+/]{1,80}$")	# Mild security measure: Precribed length and set of characters in IDs
-def readDocs (docsFile):
+def readDocList (docsFile):
+    """Yields (docID, filename) pairs without reading the documents themselves"""
     try:
         with file(docsFile, "rU") as f:
             n = 0
@@ -64,14 +71,24 @@ def readDocs (docsFile):
                     assert len(line) >= 2, "Short line"
                     id, docFile = line[:2]
                     assert idRE.match(id), "Bad ID format"
-                    with open(docFile, "rU") as d:
-                        yield dict(docID=id, source=docFile, content="".join(d))
+                    yield id, docFile
                 except Exception as e:
                     print >>sys.stderr, "Skipping %s line %d - %s" % (docsFile, n, e)
     except Exception:
-        print >sys.stderr, "Error reading docs file %r" % docsFile
+        print >>sys.stderr, "Error reading docs file %r" % docsFile
         raise
 
+def readDoc (id, docFile):
+    with open(docFile, "rU") as d:
+        return dict(docID=id, source=docFile, content="".join(d))
+
+def readDocs (docsFile):
+    for id, docFile in readDocList(docsFile):
+        try:
+            yield readDoc(id, docFile)
+        except Exception as e:
+            print >>sys.stderr, "Skipping %s document %s - %s" % (docsFile, id, e)
+
 def readAnnotations (annFile):
     try:
         with file(annFile, "rU") as f:
@@ -82,7 +99,7 @@ def readAnnotations (annFile):
                 ann["offsets"] = (start, end)
                 yield ann
     except Exception:
-        print >sys.stderr, "Error reading annotations file %r" % docsFile
+        print >>sys.stderr, "Error reading annotations file %r" % annFile
         raise
 
 def pickGloss (annotations):
@@ -93,34 +110,87 @@ def pickGloss (annotations):
     groupLength, glossLength, gloss = max((len(group), len(group[0]), group[0]) for group in glossGroups)
     return gloss   
             
-def mergeAnnotations (docs, allAnnotations, glosses=False):
-    docMap = dict((doc["docID"], doc) for doc in docs)
-    # annMap[(docID, conceptType, conceptID)] => [annotations ...]
+def groupAnnotations (someAnnotations, glosses=False):
+    """Group the annotations for a single document by (type, conceptID)"""
     annMap = collections.defaultdict(list)
-    # glosses = collections.defaultdict(lambda : collections.defaultdict(lambda : collections.defaultdict())
-    # Group the annotations by (docID, type, conceptID)
-    for a in allAnnotations:
-        annMap[(a["docID"], a["type"], a["conceptID"])].append(a)
-    for (docID, conceptType, conceptID), someAnnotations in annMap.iteritems():
-        doc = docMap[docID]
-        # Maybe docs should just be defaultdicts
-        if not doc.has_key("annotations"):
-            doc["annotations"] = list()
+    for a in someAnnotations:
+        annMap[(a["type"], a["conceptID"])].append(a)
+    groups = []
+    for (conceptType, conceptID), group in sorted(annMap.iteritems()):
         annGroup = dict(type=conceptType,
                         conceptID=conceptID,
-                        offsets=sorted(a["offsets"] for a in someAnnotations))
+                        offsets=sorted(a["offsets"] for a in group))
         if glosses:
-            annGroup["gloss"] = pickGloss(someAnnotations)
-        doc["annotations"].append(annGroup)                                       
+            annGroup["gloss"] = pickGloss(group)
+        groups.append(annGroup)
+    return groups
+
+def mergeAnnotations (docs, allAnnotations, glosses=False):
+    """Adds the grouped annotations to docs, and returns the docs that have any"""
+    docMap = dict((doc["docID"], doc) for doc in docs)
+    # annMap[docID] => [annotations ...]
+    annMap = collections.defaultdict(list)
+    for a in allAnnotations:
+        annMap[a["docID"]].append(a)
+    for docID, someAnnotations in annMap.iteritems():
+        if docID not in docMap:
+            print >>sys.stderr, "Skipping %d annotations for unknown document %s" % (len(someAnnotations), docID)
+            continue
+        docMap[docID]["annotations"] = groupAnnotations(someAnnotations, glosses=glosses)
+    reportUnannotated(docID for docID in docMap if docID not in annMap)
+    return [doc for doc in docs if "annotations" in doc]
+
+def reportUnannotated (docIDs):
+    """Documents without annotations would make no items, so neither merge writes them"""
+    docIDs = sorted(docIDs)
+    if docIDs:
+        print >>sys.stderr, "Skipping %d documents with no annotations (e.g. %s)" % (len(docIDs), " ".join(docIDs[:3]))
 
 def dumpAnnotations (out, docs):
     # Sort everything for stability
     docs.sort(key=lambda d: d["docID"])
-    for doc in docs:
-        doc["annotations"].sort(key=lambda a: (a["type"], a["conceptID"]))
     for d in docs:
         print >>out, json.dumps(d, sort_keys=True)
 
+def checkSorted (annotations, annFile):
+    lastID = None
+    for a in annotations:
+        if lastID is not None and a["docID"] < lastID:
+            raise ValueError("Annotations file %r is not sorted by docID (%s after %s)" % (annFile, a["docID"], lastID))
+        lastID = a["docID"]
+        yield a
+
+def decorateAnnotations (annFile, i):
+    """Sorted annotations as (docID, file number, line number, annotation),
+    so heapq.merge never compares the dicts themselves"""
+    for n, a in enumerate(checkSorted(readAnnotations(annFile), annFile)):
+        yield a["docID"], i, n, a
+
+def streamAnnotations (docList, annFiles, glosses=False):
+    """Like mergeAnnotations, but each annotation file must already be sorted by docID.
+    Only one document and its annotations are held in memory at a time."""
+    docFiles = dict(docList)
+    streams = [decorateAnnotations(f, i) for (i, f) in enumerate(annFiles)]
+    annotated = set()
+    nDocs = nAnnotations = 0
+    for docID, group in itertools.groupby(heapq.merge(*streams), lambda t: t[0]):
+        someAnnotations = [a for (d, i, n, a) in group]
+        nAnnotations += len(someAnnotations)
+        annotated.add(docID)
+        if docID not in docFiles:
+            print >>sys.stderr, "Skipping %d annotations for unknown document %s" % (len(someAnnotations), docID)
+            continue
+        try:
+            doc = readDoc(docID, docFiles[docID])
+        except Exception as e:
+            print >>sys.stderr, "Skipping document %s and its %d annotations - %s" % (docID, len(someAnnotations), e)
+            continue
+        doc["annotations"] = groupAnnotations(someAnnotations, glosses=glosses)
+        nDocs += 1
+        yield doc
+    reportUnannotated(docID for docID in docFiles if docID not in annotated)
+    print >>sys.stderr, "Merged %d annotations into %d documents" % (nAnnotations, nDocs)
+
 ######################################################################
 
 optparser = optparse.OptionParser()
@@ -128,18 +198,26 @@ optparser.set_usage("""Usage: %prog [options] [annfiles ...]""")
 
 optparser.add_option("--docs", help="Tab-sep file of document IDs and filenames")
 optparser.add_option("--glosses", action="store_true", help="Pick a representative string for each annotation group")
+optparser.add_option("--sorted", action="store_true",
+                     help="Annotation files are each sorted by docID (e.g. LC_ALL=C sort -k1,1); "
+                     "merge one document at a time in constant memory")
 
 (options, annFiles) = optparser.parse_args()
 
 assert options.docs, "--docs is required"
-docs = list(readDocs(options.docs))
-print >>sys.stderr, "Read %d documents" % len(docs)
-
 assert annFiles, "No annotation files"
-annotations = list(itertools.chain.from_iterable(readAnnotations(f) for f in annFiles))
-print >>sys.stderr, "Read %d annotations" % len(annotations)
 
-mergeAnnotations(docs, annotations, glosses=options.glosses)
-dumpAnnotations(sys.stdout, docs)
+if options.sorted:
+    for doc in streamAnnotations(readDocList(options.docs), annFiles, glosses=options.glosses):
+        print >>sys.stdout, json.dumps(doc, sort_keys=True)
+else:
+    docs = list(readDocs(options.docs))
+    print >>sys.stderr, "Read %d documents" % len(docs)
+
+    annotations = list(itertools.chain.from_iterable(readAnnotations(f) for f in annFiles))
+    print >>sys.stderr, "Read %d annotations" % len(annotations)
+
+    docs = mergeAnnotations(docs, annotations, glosses=options.glosses)
+    dumpAnnotations(sys.stdout, docs)
 
 ######################################################################
@@ -21,6 +21,12 @@ import sqlite3
 import json
 import collections
 import fileinput
+import multiprocessing
+import columnstore
+try:
+    import numpy
+except ImportError:
+    numpy = None    # Only needed for --intervals
 
 """
 Score Turker responses against an answer key.
@@ -110,6 +116,27 @@ class tabResponseReader:
             n += 1
         print >>sys.stderr, "%s: %d" % (self, n)
 
+class storeResponseReader:
+
+    def __init__ (self, path, itemRef="Input.itemID", answerRef="Answer.answer", abstain=None):
+        self.itemRef = itemRef
+        self.answerRef = answerRef
+        self.abstain = abstain
+        print >>sys.stderr, "%s: Reading from %s ..." % (self, path)
+        self.store = columnstore.columnStore(path)
+        # The scorer needs these for every response (AdjustedWorkTime is optional)
+        missing = [name for name in (itemRef, "WorkerId", "WorkTimeInSeconds") if name not in self.store]
+        assert not missing, "Store %s has no %s column, which simple-score.py needs" % (path, ", ".join(missing))
+
+    def __iter__ (self):
+        n = 0
+        # Only the columns the scorer uses are read
+        for row in self.store.rowDicts([self.itemRef, self.answerRef, "WorkerId", "WorkTimeInSeconds", "AdjustedWorkTime"]):
+            row[self.answerRef] = row.get(self.answerRef) or self.abstain
+            yield row
+            n += 1
+        print >>sys.stderr, "%s: Read %d" % (self, n)
+
 ######################################################################
 #
 # Scoring
@@ -126,65 +153,207 @@ def median (data):
     else:
         return data[int(l/2)]        
 
+def meanRatio (ratios):
+    """Average of num / denom over the ratios with a positive denom, None if there are none"""
+    ratios = [num / denom for (num, denom) in ratios if denom > 0]
+    return sum(ratios) / len(ratios) if ratios else None
+
+def outcomeMetrics (outcomes):
+    """Accuracy, precision, recall and F from outcome counts (last axis, see simpleScorer.add).
+    Undefined ratios are NaN."""
+    outcomes = numpy.asarray(outcomes, dtype=float)
+    total = outcomes.sum(axis=-1)
+    correct = outcomes[..., 4:].sum(axis=-1)
+    prNumerator = outcomes[..., 7]
+    precisionDenominator = outcomes[..., [2, 3, 6, 7]].sum(axis=-1)
+    recallDenominator = outcomes[..., [1, 3, 5, 7]].sum(axis=-1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return dict(accuracy=correct / total,
+                    precision=prNumerator / precisionDenominator,
+                    recall=prNumerator / recallDenominator,
+                    f=2 * prNumerator / (precisionDenominator + recallDenominator))
+
+def outcomeIntervals ((turkerIDs, outcomes, method, level, samples, seed)):
+    """Interval bounds for a chunk of Turkers, a top-level function so a process pool can run it.
+    Bootstrap resamples each Turker's coded responses, which amounts to a multinomial draw over
+    their outcome counts; beta samples the Jeffreys posteriors behind the smoothed accuracy."""
+    random = numpy.random.RandomState(seed)
+    tails = [100 * (1 - level) / 2, 100 * (1 + level) / 2]
+    intervals = {}
+    for turkerID, counts in zip(turkerIDs, outcomes):
+        n = sum(counts)
+        if not n:
+            continue
+        if method == "bootstrap":
+            metrics = outcomeMetrics(random.multinomial(n, numpy.array(counts) / n, size=samples))
+        else:
+            m = outcomeMetrics(counts)
+            def posterior (ratio, denominator):
+                if not denominator:
+                    return numpy.full(samples, numpy.nan)
+                hits = ratio * denominator
+                return random.beta(hits + 0.5, denominator - hits + 0.5, size=samples)
+            metrics = dict(accuracy=posterior(m["accuracy"], n),
+                           precision=posterior(m["precision"], sum(counts[i] for i in (2, 3, 6, 7))),
+                           recall=posterior(m["recall"], sum(counts[i] for i in (1, 3, 5, 7))))
+            metrics["f"] = 2 * metrics["precision"] * metrics["recall"] / (metrics["precision"] + metrics["recall"])
+        bounds = {}
+        for name, values in metrics.iteritems():
+            values = values[~numpy.isnan(values)]
+            low, high = numpy.percentile(values, tails) if len(values) else (None, None)
+            bounds[name + "Low"], bounds[name + "High"] = low, high
+        intervals[turkerID] = bounds
+    return intervals
+
+class exactQuantiles:
+    """Keeps every value, for an exact median"""
+
+    def __init__ (self):
+        self.values = []
+
+    def add (self, value):
+        self.values.append(value)
+
+    def __len__ (self):
+        return len(self.values)
+
+    def median (self):
+        return median(self.values)
+
+class quantileSketch:
+    """Bounded-memory quantiles: values are counted in logarithmic buckets,
+    so any quantile is within relativeError of a value actually seen"""
+
+    def __init__ (self, relativeError=0.01):
+        self.gamma = (1 + relativeError) / (1 - relativeError)
+        self.logGamma = math.log(self.gamma)
+        self.buckets = collections.defaultdict(int)
+        self.zeros = 0
+        self.n = 0
+
+    def add (self, value):
+        self.n += 1
+        if value > 0:
+            self.buckets[int(math.ceil(math.log(value) / self.logGamma))] += 1
+        else:
+            self.zeros += 1
+
+    def __len__ (self):
+        return self.n
+
+    def quantile (self, q):
+        if not self.n:
+            return None
+        rank = q * (self.n - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if rank < seen:
+                return 2 * self.gamma ** i / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def median (self):
+        return self.quantile(0.5)
+
 class simpleScorer:
     
-    def __init__ (self, responses, itemRef="Input.itemID", answerRef="Answer.answer"):
-        self.responses = list(responses)
+    def __init__ (self, references, itemRef="Input.itemID", answerRef="Answer.answer", prAnswers=set(),
+                  keepItems=False, exactMedian=False):
+        """Responses are scored one at a time as they are added, so they are not kept,
+        except for the per-item answers needed by interannotator if keepItems is set"""
+        self.references = references
         self.itemRef = itemRef
         self.answerRef = answerRef
+        self.prAnswers = set(a.lower() for a in prAnswers)
+        self.overall = collections.defaultdict(float)
+        self.turkers = collections.defaultdict(lambda : collections.defaultdict(float))
+        self.allDurations = (exactMedian and exactQuantiles or quantileSketch)()
+        self.adjustedDurations = (exactMedian and exactQuantiles or quantileSketch)()
+        self.item2responses = collections.defaultdict(dict) if keepItems else None
+        # outcomes[turkerID][code] counts keyed responses by
+        # code = 4 * correct + 2 * (response in prAnswers) + (reference in prAnswers)
+        self.outcomes = collections.defaultdict(lambda : [0] * 8)
+        self.intervals = {}
 
     labelWidth = 40
 
-    def scoreReference (self, references, smoothing=0.5, prAnswers=set()):
-        itemRef = self.itemRef
-        answerRef = self.answerRef
-        overall = collections.defaultdict(float)
-        turkers = collections.defaultdict(lambda : collections.defaultdict(float))
-        prAnswers = set(a.lower() for a in prAnswers)
-        allDurations = []
-        adjustedDurations = []
-
-        for item in self.responses:
-            itemID = item[itemRef]
-            turkerID = item["WorkerId"]
-            if itemID in references:
-                overall["total"] += 1
-                turkers[turkerID]["total"] += 1
-                ref = references[itemID].lower()
-                response = item[answerRef]
-                # xprint >>sys.stderr, turkerID, response, ref
-                if response is None:
-                    turkers[turkerID]["abstentions"] += 1
-                else:
-                    response = response.lower()
-                if ref == response:
-                    overall["correct"] += 1
-                    turkers[turkerID]["correct"] += 1
-                if ref in prAnswers:
-                    overall["recallDenominator"] += 1
-                    turkers[turkerID]["recallDenominator"] += 1                
-                if response in prAnswers:
-                    turkers[turkerID]["precisionDenominator"] += 1        
-                    overall["precisionDenominator"] += 1
-                    if ref == response:
-                        turkers[turkerID]["prNumerator"] += 1
-                        overall["prNumerator"] += 1
-            turkers[turkerID]["totalItems"] += 1
-            dur = float(item["WorkTimeInSeconds"])
-            aDur = item.get("AdjustedWorkTime", None)
-            if aDur is not None:
-                aDur = float(aDur)
-                turkers[turkerID]["duration"] += aDur
-                adjustedDurations.append(aDur)
+    def score (self, responses):
+        for item in responses:
+            self.add(item)
+
+    def add (self, item):
+        references = self.references
+        prAnswers = self.prAnswers
+        overall = self.overall
+        itemID = item[self.itemRef]
+        turkerID = item["WorkerId"]
+        response = item[self.answerRef]
+        if self.item2responses is not None:
+            self.item2responses[itemID][turkerID] = response
+        turker = self.turkers[turkerID]
+        if itemID in references:
+            overall["total"] += 1
+            turker["total"] += 1
+            ref = references[itemID].lower()
+            # xprint >>sys.stderr, turkerID, response, ref
+            if response is None:
+                turker["abstentions"] += 1
             else:
-                turkers[turkerID]["duration"] += dur
-            allDurations.append(dur)
+                response = response.lower()
+            if ref == response:
+                overall["correct"] += 1
+                turker["correct"] += 1
+            if ref in prAnswers:
+                overall["recallDenominator"] += 1
+                turker["recallDenominator"] += 1
+            if response in prAnswers:
+                turker["precisionDenominator"] += 1
+                overall["precisionDenominator"] += 1
+                if ref == response:
+                    turker["prNumerator"] += 1
+                    overall["prNumerator"] += 1
+            self.outcomes[turkerID][4 * (ref == response) + 2 * (response in prAnswers) + (ref in prAnswers)] += 1
+        turker["totalItems"] += 1
+        dur = float(item["WorkTimeInSeconds"])
+        aDur = item.get("AdjustedWorkTime", None)
+        if aDur is not None:
+            aDur = float(aDur)
+            turker["duration"] += aDur
+            self.adjustedDurations.add(aDur)
+        else:
+            turker["duration"] += dur
+        self.allDurations.add(dur)
+
+    def computeIntervals (self, method="bootstrap", level=0.95, samples=1000, jobs=1, seed=0, chunkSize=200):
+        """Intervals for each Turker's accuracy and P/R/F, from chunks of Turkers spread over jobs processes"""
+        turkerIDs = sorted(self.outcomes)
+        chunks = [(turkerIDs[i:i + chunkSize], [self.outcomes[t] for t in turkerIDs[i:i + chunkSize]],
+                   method, level, samples, seed + i)
+                  for i in xrange(0, len(turkerIDs), chunkSize)]
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            results = pool.map(outcomeIntervals, chunks)
+            pool.close()
+            pool.join()
+        else:
+            results = map(outcomeIntervals, chunks)
+        for result in results:
+            self.intervals.update(result)
+
+    def scoreReference (self, smoothing=0.5):
+        overall = self.overall
+        turkers = self.turkers
+        prAnswers = self.prAnswers
+        allDurations = self.allDurations
+        adjustedDurations = self.adjustedDurations
 
         if adjustedDurations:
             print >>sys.stderr, "Using adjusted HIT durations"
             if len(allDurations) != len(adjustedDurations):
                 print >>sys.stderr, "***** Mix of raw and adjusted durations!!! *****"
-                        
+
         for turkerID, scores in turkers.iteritems():
             scores["accuracy"] = (scores["correct"] + smoothing) / (scores["total"] + 1)
         print "======== Overall"
@@ -193,7 +362,7 @@ class simpleScorer:
         print "%20s %s" % ("Avg Turker", self.prettyPrint([(s["correct"], s["total"]) for s in turkers.itervalues()]))
         print "%20s %8.3f" % ("Median Turker",  median([s["correct"] / s["total"] for s in turkers.itervalues() if s["total"]]) or 0)
         print "%20s %s" % ("Avg Duration", self.prettyPrint([(s["duration"], s["totalItems"]) for s in turkers.itervalues()]))
-        print "%20s %8.3f (of %d)" % ("Median Duration", median(adjustedDurations or allDurations), len(adjustedDurations or allDurations))
+        print "%20s %8.3f (of %d)" % ("Median Duration", (adjustedDurations or allDurations).median() or 0, len(adjustedDurations or allDurations))
         # print "%20s %8.3f (of %d)" % ("Median Duration", median([s["duration"] / s["totalItems"] for s in turkers.itervalues() if s["total"]]), len(turkers))
 
         if prAnswers:
@@ -227,6 +396,82 @@ class simpleScorer:
                   else " " * 8)
             print "%20s%s%s%s%s%s%s" % (turkerID, acc, p, r, f, dur, ab)
 
+        if self.intervals:
+            names = ["accuracy"] + (prAnswers and ["precision", "recall", "f"] or [])
+            print "%-20s%s" % ("======== Intervals", "".join(" %-17s" % n.capitalize() for n in names))
+            for turkerID in sorted(self.intervals, key=lambda t: (turkers[t]["accuracy"], turkers[t]["total"]), reverse=True):
+                bounds = self.intervals[turkerID]
+                print "%20s%s" % (turkerID, "".join("%8s" % "---" + " " * 11 if bounds[n + "Low"] is None
+                                                    else " %.3f - %.3f    " % (bounds[n + "Low"], bounds[n + "High"])
+                                                    for n in names))
+
+    def report (self, smoothing=0.5):
+        """The overall block and the per-Turker table as records, computed from the counters.
+        Ratios with no denominator are None."""
+        overall = self.overall
+        turkers = self.turkers
+        prAnswers = self.prAnswers
+        durations = self.adjustedDurations or self.allDurations
+        summary = dict(record="overall",
+                       turkers=len(turkers),
+                       total=int(overall["total"]),
+                       correct=int(overall["correct"]),
+                       accuracy=meanRatio([(overall["correct"], overall["total"])]),
+                       avgTurkerAccuracy=meanRatio([(t["correct"], t["total"]) for t in turkers.itervalues()]),
+                       medianTurkerAccuracy=median([t["correct"] / t["total"] for t in turkers.itervalues() if t["total"]]),
+                       avgDuration=meanRatio([(t["duration"], t["totalItems"]) for t in turkers.itervalues()]),
+                       medianDuration=durations.median(),
+                       durations=len(durations),
+                       adjustedDurations=bool(self.adjustedDurations))
+        if prAnswers:
+            summary.update(precision=meanRatio([(overall["prNumerator"], overall["precisionDenominator"])]),
+                           recall=meanRatio([(overall["prNumerator"], overall["recallDenominator"])]),
+                           avgTurkerPrecision=meanRatio([(t["prNumerator"], t["precisionDenominator"]) for t in turkers.itervalues()]),
+                           avgTurkerRecall=meanRatio([(t["prNumerator"], t["recallDenominator"]) for t in turkers.itervalues()]))
+        records = []
+        for turkerID, t in turkers.iteritems():
+            record = dict(record="turker",
+                          WorkerId=turkerID,
+                          total=int(t["total"]),
+                          correct=int(t["correct"]),
+                          accuracy=meanRatio([(t["correct"], t["total"])]),
+                          smoothedAccuracy=(t["correct"] + smoothing) / (t["total"] + 1),
+                          items=int(t["totalItems"]),
+                          duration=t["duration"] / t["totalItems"],
+                          abstentions=int(t["abstentions"]),
+                          abstentionRate=t["abstentions"] / t["totalItems"])
+            if prAnswers:
+                record.update(precision=meanRatio([(t["prNumerator"], t["precisionDenominator"])]),
+                              recall=meanRatio([(t["prNumerator"], t["recallDenominator"])]),
+                              f=(2 * t["prNumerator"] / ((t["precisionDenominator"] + t["recallDenominator"]) or 1)
+                                 if t["precisionDenominator"] or t["recallDenominator"] else None))
+            record.update(self.intervals.get(turkerID, {}))
+            records.append(record)
+        records.sort(key=lambda r: (r["smoothedAccuracy"], r["total"]), reverse=True)
+        return summary, records
+
+    turkerColumns = "record WorkerId total correct accuracy smoothedAccuracy precision recall f items duration abstentions abstentionRate".split()
+
+    # The rest of the overall record, left empty on the Turker rows
+    overallColumns = ("turkers avgTurkerAccuracy medianTurkerAccuracy avgTurkerPrecision avgTurkerRecall"
+                      " avgDuration medianDuration durations adjustedDurations").split()
+
+    intervalColumns = "accuracyLow accuracyHigh precisionLow precisionHigh recallLow recallHigh fLow fHigh".split()
+
+    def writeReport (self, out, format, smoothing=0.5):
+        """Writes the report records as JSON lines, or as a tab-sep table with the overall record first"""
+        summary, records = self.report(smoothing)
+        columns = self.turkerColumns + self.overallColumns + (self.intervals and self.intervalColumns or [])
+        if format == "json":
+            for record in [summary] + records:
+                print >>out, json.dumps(record, sort_keys=True)
+        else:
+            writer = csv.DictWriter(out, columns, dialect=csv.excel_tab)
+            writer.writerow(dict(zip(columns, columns)))
+            for record in [summary] + records:
+                writer.writerow(dict((k, "" if v is None else (v.encode("utf8") if isinstance(v, unicode) else v))
+                                     for k, v in record.iteritems()))
+
     # def report1 (self, label, ratios, figure=None):
     #     # Unused?
     #     """Ratios looks like [(num, denom) ...]"""
@@ -262,28 +507,73 @@ class simpleScorer:
         else:
             return "%8.3f %-11s" % (figure, note)
 
-    def interannotator (self):
-        itemRef = self.itemRef
-        answerRef = self.answerRef
-        item2responses = collections.defaultdict(dict)
-        for item in self.responses:
-            itemID = item[itemRef]
-            turkerID = item["WorkerId"]
-            response = item[answerRef]
-            item2responses[itemID][turkerID] = response
-        pairs = collections.defaultdict(lambda : collections.defaultdict(int))
+    def agreement (self, pairs=False):
+        """Agreement from per-item label counts, which is linear in the number of responses.
+        The per-pair table is quadratic in the responses per item, so only computed if pairs is set."""
+        item2responses = self.item2responses
+        assert item2responses is not None, "Scorer was not keeping per-item responses"
+        agreed = total = 0
+        kappaItems = 0
+        kappaSum = 0.0
+        labelTotals = collections.defaultdict(int)  # Non-abstaining responses per label, over items with 2+ of them
+        coincidences = 0.0                          # Diagonal of Krippendorff's coincidence matrix
         for responses in item2responses.itervalues():
-            for turker1, response1 in responses.iteritems():
-                for turker2, response2 in responses.iteritems():
-                    if turker2 > turker1:
-                        pairs[(turker1, turker2)]["total"] += 1
-                        if response1 == response2:
-                            pairs[(turker1, turker2)]["agreed"] += 1
-        totalAgreement = 0
-        print "\n========== Simple interannotator agreement"
-        for pair, data in pairs.iteritems():
-            print "%15s %-15s %s" % (pair[0], pair[1], self.prettyPrint([(data["agreed"], data["total"])]))
-        print "%31s %s" % ("Average", self.prettyPrint([(d["agreed"], d["total"]) for d in pairs.itervalues()]))
+            counts = collections.Counter(responses.itervalues())
+            n = len(responses)
+            # Abstentions count as a label for raw agreement, as in the pairwise table
+            agreed += sum(c * (c - 1) for c in counts.itervalues()) // 2
+            total += n * (n - 1) // 2
+            del counts[None]
+            n = sum(counts.itervalues())
+            if n > 1:
+                same = sum(c * (c - 1) for c in counts.itervalues())
+                kappaItems += 1
+                kappaSum += same / (n * (n - 1))
+                coincidences += same / (n - 1)
+                for label, c in counts.iteritems():
+                    labelTotals[label] += c
+        result = dict(record="agreement", agreed=agreed, pairs=total, kappaItems=kappaItems,
+                      agreement=meanRatio([(agreed, total)]), fleissKappa=None, krippendorffAlpha=None)
+        n = sum(labelTotals.itervalues())
+        expected = sum((c / n) ** 2 for c in labelTotals.itervalues()) if n else 0.0
+        if kappaItems and expected < 1:
+            # Fleiss' kappa, allowing for a varying number of responses per item
+            result["fleissKappa"] = (kappaSum / kappaItems - expected) / (1 - expected)
+            # Krippendorff's alpha, nominal
+            result["krippendorffAlpha"] = 1 - (n - 1) * (n - coincidences) / (n * n - sum(c * c for c in labelTotals.itervalues()))
+        if pairs:
+            pairTable = collections.defaultdict(lambda : collections.defaultdict(int))
+            for responses in item2responses.itervalues():
+                for turker1, response1 in responses.iteritems():
+                    for turker2, response2 in responses.iteritems():
+                        if turker2 > turker1:
+                            pairTable[(turker1, turker2)]["total"] += 1
+                            if response1 == response2:
+                                pairTable[(turker1, turker2)]["agreed"] += 1
+            result["pairTable"] = pairTable
+        return result
+
+    def interannotator (self, pairs=False, format="text", out=sys.stdout):
+        result = self.agreement(pairs)
+        pairTable = result.pop("pairTable", {})
+        if format == "json":
+            for pair, data in pairTable.iteritems():
+                print >>out, json.dumps(dict(record="pair", WorkerId1=pair[0], WorkerId2=pair[1],
+                                             agreed=data["agreed"], total=data["total"]), sort_keys=True)
+            print >>out, json.dumps(result, sort_keys=True)
+            return
+        print >>out, "\n========== Simple interannotator agreement"
+        if pairs:
+            for pair, data in pairTable.iteritems():
+                print >>out, "%15s %-15s %s" % (pair[0], pair[1], self.prettyPrint([(data["agreed"], data["total"])]))
+            print >>out, "%31s %s" % ("Average", self.prettyPrint([(d["agreed"], d["total"]) for d in pairTable.itervalues()]))
+        print >>out, "%31s %s" % ("Pooled pairs", self.prettyPrint([(result["agreed"], result["pairs"])]))
+        if result["fleissKappa"] is not None:
+            print >>out, "%31s %8.3f (of %d items)" % ("Fleiss' kappa", result["fleissKappa"], result["kappaItems"])
+            print >>out, "%31s %8.3f" % ("Krippendorff's alpha", result["krippendorffAlpha"])
+        else:
+            print >>out, "%31s %8s" % ("Fleiss' kappa", "---")
+            print >>out, "%31s %8s" % ("Krippendorff's alpha", "---")
 
 # class dbWriter:
 
@@ -371,11 +661,23 @@ optparser.add_option("-v", "--verbose", dest="verbose", action = "count",
                   help = "More verbose output")
 optparser.add_option("--references", metavar="FILE", help="Read reference answers from FILENAME in TSV format")
 optparser.add_option("--tsv", action="store_true", help="Input lines are in tab-sep format")
+optparser.add_option("--store", metavar="DIR", help="Read responses from a column store written by unbundle-hits.py --store")
 optparser.add_option("--abstain", metavar="NOANSWER", default=None, help="Interpret no answer as NOANSWER")
 optparser.add_option("--items", metavar="NAME", default="Input.itemID", help="Use NAME for item ID identifier (default %default)")
 optparser.add_option("--answers", metavar="NAME", default="Answer.answer", help="Use NAME for answer identifier (default %default)")
 optparser.add_option("--pr", metavar="ANSWERS", default="", help="""Report precision, recall, F-measure. ANSWERS is a list of "true" labels.""")
 optparser.add_option("--inter", action="store_true", help="Report simple inter-annotator agreement")
+optparser.add_option("--pairs", action="store_true", help="With --inter, also report agreement for every pair of Turkers")
+optparser.add_option("--format", choices=("text", "json", "tsv"), default="text",
+                     help="Report as text, JSON records or a tab-sep per-Turker table (default %default)")
+optparser.add_option("--intervals", choices=("bootstrap", "beta"),
+                     help="Report bootstrap or Beta-posterior intervals for each Turker's accuracy and P/R/F (requires NumPy)")
+optparser.add_option("--level", type=float, default=0.95, help="Interval coverage (default %default)")
+optparser.add_option("--samples", type=int, default=1000, help="Samples per Turker for --intervals (default %default)")
+optparser.add_option("--seed", type=int, default=0, help="Random seed for --intervals (default %default)")
+optparser.add_option("-j", "--jobs", type=int, default=1, help="Processes for --intervals (default %default)")
+optparser.add_option("--exact", action="store_true",
+                     help="Keep every duration for an exact median (default is a bounded-memory estimate within 1%)")
 
 # optparser.add_option("-o", "--output", dest="output", help="write HITs to FILE", metavar="FILE")
 # optparser.add_option("--refcol", help="Load reference tables using COLNAME", metavar="COLNAME")
@@ -392,17 +694,32 @@ assert options.references, "--references argument required"
 # Main
 
 # print >>sys.stderr, infile
-responses = (tabResponseReader if options.tsv 
-             else jsonResponseReader)(fileinput.input(infiles),
-                                      itemRef=options.items, answerRef=options.answers,
-                                      abstain=options.abstain)
-responses = list(responses)
+if options.store:
+    responses = storeResponseReader(options.store, itemRef=options.items, answerRef=options.answers,
+                                    abstain=options.abstain)
+else:
+    responses = (tabResponseReader if options.tsv 
+                 else jsonResponseReader)(fileinput.input(infiles),
+                                          itemRef=options.items, answerRef=options.answers,
+                                          abstain=options.abstain)
 references = readReferences(options.references)
 
-scorer = simpleScorer(responses, itemRef=options.items, answerRef=options.answers)
-scorer.scoreReference(references, prAnswers=set(options.pr.split()))
+scorer = simpleScorer(references, itemRef=options.items, answerRef=options.answers, prAnswers=options.pr.split(),
+                      keepItems=options.inter, exactMedian=options.exact)
+scorer.score(responses)
+if options.intervals:
+    assert numpy, "--intervals requires the numpy package"
+    scorer.computeIntervals(options.intervals, level=options.level, samples=options.samples,
+                            jobs=options.jobs, seed=options.seed)
+if options.format == "text":
+    scorer.scoreReference()
+else:
+    scorer.writeReport(sys.stdout, options.format)
 if options.inter:
-    scorer.interannotator()
+    # The tab-sep table has no place for agreement figures, so they go to stderr as text
+    scorer.interannotator(pairs=options.pairs,
+                          format="json" if options.format == "json" else "text",
+                          out=sys.stderr if options.format == "tsv" else sys.stdout)
 
 # loader = dbWriter(options.db)
 # loader.loadQuestions(responses, options.questioncols)
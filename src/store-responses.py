@@ -0,0 +1,64 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sys
+import csv
+import json
+import optparse
+import fileinput
+import columnstore
+
+"""
+Converts unbundled responses (JSON lines, or tab-sep with --tsv) into a
+column store (see columnstore.py), so that naive-bayes.py and
+simple-score.py --store can share one parsed, memory-mapped copy.
+
+unbundle-hits.py --store writes the same thing directly from a batch file.
+"""
+
+csv.field_size_limit(10**6)
+
+######################################################################
+
+def jsonRows (file):
+    for line in file:
+        yield json.loads(line)
+
+def tabRows (file):
+    for row in csv.DictReader(file, dialect=csv.excel_tab):
+        yield dict((key, val.decode("utf8")) for key, val in row.iteritems() if val)
+
+def keepColumns (rows, names):
+    for row in rows:
+        yield dict((name, row[name]) for name in names if name in row)
+
+######################################################################
+
+optparser = optparse.OptionParser(usage="%prog [options] --store DIR [RESPONSEFILES]")
+optparser.add_option("-v", "--verbose", action="count", help="More verbose output")
+optparser.add_option("--store", metavar="DIR", help="Write the column store to DIR")
+optparser.add_option("--tsv", action="store_true", help="Input lines are in tab-sep format")
+optparser.add_option("--columns", metavar="NAMES",
+                     help="Keep only these columns (default all), e.g. \"WorkerId Input.itemID Answer.answer"
+                     " WorkTimeInSeconds AdjustedWorkTime\"; simple-score.py needs the work times, naive-bayes.py does not")
+
+(options, args) = optparser.parse_args()
+
+assert options.store, "--store is required"
+
+rows = (tabRows if options.tsv else jsonRows)(fileinput.input(args))
+if options.columns:
+    rows = keepColumns(rows, options.columns.split())
+columnstore.columnStoreWriter(options.store).writeAll(rows)
+
+######################################################################
@@ -7,8 +7,15 @@ import json
 import optparse
 import fileinput
 import collections
+import itertools
 import datetime
 import time
+import columnstore
+import blobstore
+try:
+    import numpy
+except ImportError:
+    numpy = None    # adjustTimes falls back to sorting in Python
 
 """
 Essentially reverses the process of bundle-items.
@@ -17,7 +24,8 @@ Processes the CSV download from MTurk and bursts out multiple items in each HIT.
 Each field name that ends in "_1", "_2" etc is assumed to be such a multiplexed field.
 Any other fields will be repeated in the output.
 
-Can produce JSON format rather than CSV if desired.
+Can produce JSON format rather than CSV if desired, or a column store
+(see columnstore.py) that the scoring scripts can read without parsing.
 """
 
 csv.field_size_limit(10**6)
@@ -66,6 +74,19 @@ def readBatchFile (input):
     # print >>sys.stderr, self, self.csvReader.fieldnames
     print >>sys.stderr, "%d batch items read" % n
 
+def readAssignmentTimes (input):
+    """Cheap first pass over a batch file: only the columns adjustTimes needs"""
+    reader = csv.reader(input)
+    header = reader.next()
+    columns = [header.index(key) for key in ("AssignmentId", "WorkerId", "AcceptTime", "SubmitTime")]
+    for row in reader:
+        yield dict(zip(("AssignmentId", "WorkerId", "AcceptTime", "SubmitTime"), [row[i] for i in columns]))
+
+def addAdjustedTimes (bundles, adjustedTimes):
+    for b in bundles:
+        b["AdjustedWorkTime"] = adjustedTimes[b["AssignmentId"]]
+        yield b
+
 # class hitUnbundler:
 
 #     def __init__ (self, source, burstplain=False, addSequenceID=False):
@@ -74,26 +95,35 @@ def readBatchFile (input):
 #         self.splitKeyRE = re.compile(burstplain and "^(.*[^0-9])([0-9]+)$" or "^(.+)_([0-9]+)$",
 #                                      re.U | re.I)
 
-def burstBundle (bundle, splitKeyRE):
-        burst = {}      # Maps sequence number to attributes with that numeric suffix
-        shared = {}     # Attributes without a numeric suffix
-        for key in bundle:
+class bundleSchema:
+    """Splits the column names of a batch file once, into burst columns (base key and index)
+    and shared columns, so each row can be burst with plain lookups"""
+
+    def __init__ (self, keys, splitKeyRE):
+        groups = {}     # Maps sequence number to [(column, base key) ...] with that numeric suffix
+        self.shared = []
+        for key in keys:
             m = splitKeyRE.match(key)
             if m:
                 newKey, index = m.groups()
                 index = int(index)
                 assert(index > 0)
-                subBundle = burst.get(index, None)
-                if not subBundle:
-                    burst[index] = subBundle = {}
-                subBundle[newKey] = bundle[key]
+                groups.setdefault(index, []).append((key, newKey))
             else:
-                shared[key] = bundle[key]
+                self.shared.append(key)
+        self.groups = sorted(groups.iteritems())
+
+    def burst (self, bundle):
+        burst = {}      # Maps sequence number to attributes with that numeric suffix
+        for index, columns in self.groups:
+            burst[index] = dict((newKey, bundle[key]) for (key, newKey) in columns)
+        shared = dict((key, bundle[key]) for key in self.shared)
         return burst, shared
 
 def unbundleHITs (source, burstplain=False, addSequenceID=False):
         splitKeyRE = re.compile(burstplain and "^(.*[^0-9])([0-9]+)$" or "^(.+)_([0-9]+)$",
                                      re.U | re.I)
+        schemas = {}    # All rows of a batch normally share one set of columns
         nIn = nOut = 0
 #       indexCount = {}
         for bundle in source:
@@ -101,7 +131,11 @@ def unbundleHITs (source, burstplain=False, addSequenceID=False):
 #           tempIndex = {}
 #           for index in tempIndex:
 #               indexCount[index] = indexCount.get(index, 0) + 1
-            burst, shared = burstBundle(bundle, splitKeyRE)
+            keys = tuple(bundle)
+            schema = schemas.get(keys)
+            if schema is None:
+                schema = schemas[keys] = bundleSchema(keys, splitKeyRE)
+            burst, shared = schema.burst(bundle)
             if addSequenceID:
                 for index, subBundle in burst.iteritems():
                     subBundle["sequenceID"] = index
@@ -116,23 +150,78 @@ def unbundleHITs (source, burstplain=False, addSequenceID=False):
                 yield item
         print >>sys.stderr, "%s: %d => %d" % ("unbundle", nIn, nOut)
 
+def rehydrateItems (items, store, fields):
+    """Puts back the values bundle-hits.py --dedup replaced with digests.
+    The store holds the cells as they would have been written, so they are
+    encoded and whitespace-normalized just as readBatchFile does for the batch file"""
+    for item in items:
+        for key in fields:
+            if item.get(key):
+                item[key] = wsRE.sub(" ", store.get(item[key]).encode("utf8"))
+        yield item
+
+class timestampParser:
+    """Parses MTurk timestamps like "Wed Jul 15 10:23:45 PDT 2015" into epoch seconds.
+    Gives the same result as time.mktime on strptime with the timezone clipped out,
+    but only calls mktime once per distinct hour, and caches whole timestamps."""
+
+    months = dict((m, i) for (i, m) in enumerate("Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split(), 1))
+
+    def __init__ (self):
+        self.cache = {}
+        self.hours = {}
+
+    def __call__ (self, t):
+        try:
+            return self.cache[t]
+        except KeyError:
+            pass
+        fields = t.split()
+        # Timezone is not reliably parseable, and is ignored as before
+        dow, month, day, hms, year = fields[:4] + fields[-1:]
+        hour, minute, second = hms.split(":")
+        hourKey = (int(year), self.months[month], int(day), int(hour))
+        base = self.hours.get(hourKey)
+        if base is None:
+            base = self.hours[hourKey] = time.mktime(hourKey + (0, 0, 0, 0, -1))
+        self.cache[t] = seconds = base + int(minute) * 60 + int(second)
+        return seconds
+
 def adjustTimes (bundles):
-    groups = collections.defaultdict(list)
+    """Adds AdjustedWorkTime: time from accept, or from the same worker's previous submit if later"""
+    parse = timestampParser()
+    workers = {}
+    workerCodes, aTimes, sTimes = [], [], []
     for b in bundles:
-        # Clip out the timezone, which is not reliably parsed by strptime
-        aTime, sTime = map(lambda t: time.mktime(datetime.datetime.strptime(t[:-8] + t[-5:], "%a %b %d %H:%M:%S %Y").timetuple()),
-                           (b["AcceptTime"], b["SubmitTime"]))
-        groups[b["WorkerId"]].append((sTime, aTime, b))
-    origWorktime = adjustedWorktime = 0
-    for workerID, bundles in groups.iteritems():
-        lastSubmit = 0
-        bundles.sort()
-        for i, (sTime, aTime, b) in enumerate(bundles):
-            b["AdjustedWorkTime"] = sTime - max(aTime, lastSubmit)
-            assert b["AdjustedWorkTime"] >= 0
-            # if b["AdjustedWorkTime"] == 0:
-            #     print >>sys.stderr, "Zero work time!!! (%s %s), (%s %s)" % (bundles[i - 1][-1]["AcceptTime"], bundles[i - 1][-1]["SubmitTime"], b["AcceptTime"], b["SubmitTime"])
-            lastSubmit = sTime
+        workerCodes.append(workers.setdefault(b["WorkerId"], len(workers)))
+        aTimes.append(parse(b["AcceptTime"]))
+        sTimes.append(parse(b["SubmitTime"]))
+    for b, adjusted in itertools.izip(bundles, adjustedWorkTimes(workerCodes, aTimes, sTimes)):
+        b["AdjustedWorkTime"] = adjusted
+
+def adjustedWorkTimes (workerCodes, aTimes, sTimes):
+    """Sorts each worker's assignments by submit time, and returns adjusted work times in the original order"""
+    if numpy is None:
+        order = sorted(xrange(len(sTimes)), key=lambda i: (workerCodes[i], sTimes[i], aTimes[i]))
+        adjusted = [None] * len(sTimes)
+        lastWorker = lastSubmit = None
+        for i in order:
+            if workerCodes[i] != lastWorker:
+                lastWorker, lastSubmit = workerCodes[i], 0
+            adjusted[i] = sTimes[i] - max(aTimes[i], lastSubmit)
+            assert adjusted[i] >= 0
+            lastSubmit = sTimes[i]
+        return adjusted
+    w, a, s = numpy.array(workerCodes), numpy.array(aTimes, dtype=float), numpy.array(sTimes, dtype=float)
+    order = numpy.lexsort((a, s, w))
+    w, a, s = w[order], a[order], s[order]
+    lastSubmit = numpy.zeros(len(s))
+    lastSubmit[1:] = s[:-1]
+    lastSubmit[numpy.flatnonzero(w[1:] != w[:-1]) + 1] = 0
+    adjusted = numpy.empty(len(s))
+    adjusted[order] = s - numpy.maximum(a, lastSubmit)
+    assert (adjusted >= 0).all()
+    return adjusted.tolist()
         
 class tabItemWriter:
 
@@ -189,19 +278,40 @@ optparser.add_option("--plain", action="store_true",
 optparser.add_option("--addseq", action="store_true", help="Add a sequence ID to the burst items")
 optparser.add_option("--json", action="store_true",
                      help="Produce json output rather than tab-sep")
+optparser.add_option("--rehydrate", default=[], action="append", metavar="FIELD",
+                     help="Replace the digest in each FIELD (e.g. Input.content) with its value from --blobs")
+optparser.add_option("--blobs", metavar="DIR", help="Content-addressed store written by bundle-hits.py --dedup")
+optparser.add_option("--store", metavar="DIR",
+                     help="Write a column store to DIR rather than text to standard output")
 
 (options, args) = optparser.parse_args()
 
 # (infile, ) = args or (None, )
 # infile = infile in ("-", None) and sys.stdin or open(infile, "r")
 
-bundles = list(readBatchFile(fileinput.input(args)))
-adjustTimes(bundles)
-
-print >>sys.stderr, "Average adjusted worktime %.1fs" % (sum(b["AdjustedWorkTime"] for b in bundles)/(len(bundles) or 1))
+if args and "-" not in args:
+    # Two passes, so only the timing columns are ever held for the whole batch
+    assignments = list(readAssignmentTimes(fileinput.input(args)))
+    adjustTimes(assignments)
+    adjustedTimes = dict((a["AssignmentId"], a["AdjustedWorkTime"]) for a in assignments)
+    del assignments
+    bundles = addAdjustedTimes(readBatchFile(fileinput.input(args)), adjustedTimes)
+else:
+    # Standard input can only be read once
+    bundles = list(readBatchFile(fileinput.input(args)))
+    adjustTimes(bundles)
+    adjustedTimes = dict((b["AssignmentId"], b["AdjustedWorkTime"]) for b in bundles)
+
+print >>sys.stderr, "Average adjusted worktime %.1fs" % (sum(adjustedTimes.itervalues())/(len(adjustedTimes) or 1))
 
 items = unbundleHITs(bundles, burstplain=options.plain, addSequenceID=options.addseq)
-writer = (options.json and jsonItemWriter or tabItemWriter)(sys.stdout)
+if options.rehydrate:
+    assert options.blobs, "--rehydrate requires --blobs"
+    items = rehydrateItems(items, blobstore.blobStore(options.blobs), options.rehydrate)
+if options.store:
+    writer = columnstore.columnStoreWriter(options.store)
+else:
+    writer = (options.json and jsonItemWriter or tabItemWriter)(sys.stdout)
 writer.writeAll(items)
 
 ######################################################################
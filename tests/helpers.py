@@ -0,0 +1,63 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+"""
+Shared fixtures for the tests, which mostly run the scripts in src on small
+generated files.  Run with: python -m unittest discover tests
+"""
+
+src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, src)
+
+######################################################################
+
+def runScript (name, *args):
+    """Runs one of the scripts in src, returning its standard output"""
+    with open(os.devnull, "w") as devnull:
+        return subprocess.check_output([sys.executable, os.path.join(src, name)] + list(args), stderr=devnull)
+
+def runScriptFailing (name, *args):
+    """Runs one of the scripts in src, expecting it to fail, and returns its standard error"""
+    script = subprocess.Popen([sys.executable, os.path.join(src, name)] + list(args),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = script.communicate()
+    assert script.returncode, "%s %s did not fail" % (name, " ".join(args))
+    return err
+
+class tempDirTest (unittest.TestCase):
+    """A test with a scratch directory, self.path, removed afterwards"""
+
+    def setUp (self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown (self):
+        shutil.rmtree(self.path)
+
+    def filename (self, name):
+        return os.path.join(self.path, name)
+
+    def writeLines (self, name, lines):
+        """Writes lines to a file in the scratch directory, returning its name"""
+        with open(self.filename(name), "w") as f:
+            for line in lines:
+                print >>f, line
+        return self.filename(name)
+
+######################################################################
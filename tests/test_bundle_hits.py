@@ -0,0 +1,72 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import csv
+import json
+import helpers
+
+######################################################################
+
+class bundleHitsTest (helpers.tempDirTest):
+
+    def setUp (self):
+        helpers.tempDirTest.setUp(self)
+        labels = [u"caf\xe9 <b>label</b>", u"line1\nline2", u"plain", u"tab\there"]
+        self.items = self.writeLines("items.json",
+                                     [json.dumps({"itemID": "I%d" % i, "content": labels[i % len(labels)],
+                                                  "meta": {"n": i, "label": labels[i % len(labels)]}})
+                                      for i in xrange(30)])
+
+    def fakeResults (self, batch, name):
+        """A batch results file, as if each HIT had been done once"""
+        with open(batch) as f:
+            rows = list(csv.reader(f))
+        with open(self.filename(name), "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Input." + key for key in rows[0]]
+                            + ["AssignmentId", "WorkerId", "AcceptTime", "SubmitTime"])
+            for n, row in enumerate(rows[1:]):
+                writer.writerow(row + ["A%d" % n, "W%d" % (n % 3),
+                                       "Wed Jul 15 10:23:45 PDT 2015", "Wed Jul 15 10:24:%02d PDT 2015" % n])
+        return self.filename(name)
+
+    def unbundled (self, dedupArgs, rehydrateArgs, extraArgs=()):
+        name = "dedup" if dedupArgs else "plain"
+        batch = self.filename(name + ".csv")
+        helpers.runScript("bundle-hits.py", "-n", "3", "-o", batch, *(list(extraArgs) + list(dedupArgs) + [self.items]))
+        results = self.fakeResults(batch, name + "-results.csv")
+        return (helpers.runScript("unbundle-hits.py", "--json", *(rehydrateArgs + [results])),
+                helpers.runScript("unbundle-hits.py", *(rehydrateArgs + [results])))
+
+    def testDedupRoundTrip (self):
+        blobs = self.filename("blobs")
+        for extraArgs in ((), ("--noclean", ), ("--noclean", "--htmlize", "content", "--jsonize", "meta")):
+            plain = self.unbundled([], [], extraArgs)
+            dedup = self.unbundled(["--dedup", "content", "--dedup", "meta", "--blobs", blobs],
+                                   ["--rehydrate", "Input.content", "--rehydrate", "Input.meta", "--blobs", blobs],
+                                   extraArgs)
+            self.assertEqual(dedup, plain)
+
+    def testGoldPositions (self):
+        gold = self.writeLines("gold.txt", ["I%d" % i for i in xrange(0, 30, 5)])
+        for n, goldRate in ((3, "1"), (4, "0.3"), (4, "2")):
+            batch = self.filename("gold.csv")
+            helpers.runScript("bundle-hits.py", "-n", str(n), "--gold", gold, "--goldrate", goldRate, "-o", batch, self.items)
+            with open(batch) as f:
+                rows = list(csv.DictReader(f))
+            positions = ["isGold_%d" % (i + 1) for i in xrange(n)]
+            # Every position has an isGold column, and gets gold in some bundle
+            self.assertTrue(set(positions).issubset(rows[0]))
+            self.assertEqual([p for p in positions if any(row[p] for row in rows)], positions)
+
+######################################################################
@@ -0,0 +1,41 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import helpers
+import columnstore
+
+######################################################################
+
+class columnStoreTest (helpers.tempDirTest):
+
+    def roundTrip (self, rows, bufferRows=None):
+        writer = columnstore.columnStoreWriter(self.path)
+        if bufferRows:
+            writer.bufferRows = bufferRows
+        writer.writeAll(rows)
+        store = columnstore.columnStore(self.path)
+        names = sorted(set(name for row in rows for name in row))
+        return list(store.rowDicts(names))
+
+    def testRaggedRows (self):
+        # A new column arriving partway through a row used to flush the others mid-row
+        rows = [{"a": 1, "b": 2}, {"b": 3, "c": 4, "a": 5}]
+        self.assertEqual(self.roundTrip(rows), rows)
+
+    def testRaggedRowsAcrossFlushes (self):
+        rows = [{"a": 1, "b": 2}, {"b": 3, "c": 4, "a": 5}, {"a": 6},
+                {"d": u"\xe9", "b": 8}, {"c": 9}, {}, {"e": [1, 2], "a": 1}]
+        for bufferRows in (1, 2, 3, 4096):
+            self.assertEqual(self.roundTrip(rows, bufferRows), rows)
+
+######################################################################
@@ -0,0 +1,57 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import random
+import helpers
+
+######################################################################
+
+class naiveBayesTest (helpers.tempDirTest):
+
+    def setUp (self):
+        helpers.tempDirTest.setUp(self)
+        rng = random.Random(1)
+        self.responses = [{"WorkerId": "W%d" % rng.randrange(8), "Input.itemID": "I%d" % rng.randrange(40),
+                           "Answer.answer": rng.choice(["yes", "no"])}
+                          for n in xrange(300)]
+        self.key = self.writeLines("key.tsv", ["I%d\t%s" % (i, rng.choice(["yes", "no"])) for i in xrange(10)])
+
+    def testStoreSkipsRowsWithoutItemOrWorker (self):
+        ragged = []
+        for n, response in enumerate(self.responses):
+            ragged.append(response)
+            if not n % 50:
+                ragged.append({"WorkerId": "WX", "Answer.answer": "yes"})
+                ragged.append({"Input.itemID": "IX", "Answer.answer": "no"})
+        full = self.writeLines("full.json", map(json.dumps, self.responses))
+        store = self.filename("store")
+        helpers.runScript("store-responses.py", "--store", store, self.writeLines("ragged.json", map(json.dumps, ragged)))
+        self.assertEqual(helpers.runScript("naive-bayes.py", "-k", self.key, "--store", store),
+                         helpers.runScript("naive-bayes.py", "-k", self.key, full))
+
+    def testStateAddsEachBatchOnce (self):
+        state = self.filename("state.npz")
+        first = self.writeLines("first.json", map(json.dumps, self.responses[:150]))
+        second = self.writeLines("second.json", map(json.dumps, self.responses[150:]))
+        # A single batch scores as the batch engine does, to rounding
+        scores = [json.loads(line)["Answer.score"] for line in helpers.runScript("naive-bayes.py", "-k", self.key, "--state", state, first).splitlines()]
+        expected = [json.loads(line)["Answer.score"] for line in helpers.runScript("naive-bayes.py", "-k", self.key, "--numpy", first).splitlines()]
+        self.assertEqual(len(scores), len(expected))
+        for score, e in zip(scores, expected):
+            self.assertAlmostEqual(score, e)
+        added = helpers.runScript("naive-bayes.py", "-k", self.key, "--state", state, second, first)
+        self.assertEqual(helpers.runScript("naive-bayes.py", "-k", self.key, "--state", state, second), added)
+        self.assertEqual(helpers.runScript("naive-bayes.py", "-k", self.key, "--state", state, first, second), added)
+
+######################################################################
@@ -0,0 +1,53 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import helpers
+
+######################################################################
+
+class simpleMergeTest (helpers.tempDirTest):
+
+    def setUp (self):
+        helpers.tempDirTest.setUp(self)
+        for docID, text in (("d1", "hello world"), ("d3", "third doc")):
+            self.writeLines(docID + ".txt", [text])
+        self.annotations = [self.writeLines("a1.tsv", ["d1\tT\t0\t5\tC1\thello", "d2\tT\t0\t1\tC2\tx", "d3\tT\t0\t5\tC3\tthird"]),
+                            self.writeLines("a2.tsv", ["d1\tT\t6\t11\tC1\tworld", "d3\tT\t6\t9\tC4\tdoc"])]
+
+    def docList (self, docIDs):
+        return self.writeLines("docs.tsv", ["%s\t%s" % (docID, self.filename(docID + ".txt")) for docID in docIDs])
+
+    def testSortedMatchesUnsorted (self):
+        annotations = [self.writeLines("a3.tsv", ["d1\tT\t0\t5\tC1\thello", "d3\tT\t0\t5\tC3\tthird"]),
+                       self.annotations[1]]
+        docs = self.docList(["d1", "d3"])
+        self.assertEqual(helpers.runScript("simple-merge.py", "--sorted", "--glosses", "--docs", docs, *annotations),
+                         helpers.runScript("simple-merge.py", "--glosses", "--docs", docs, *annotations))
+
+    def testBothSkipDocumentsWithoutAnnotations (self):
+        # d4 has no annotations, and d2 has annotations but no document
+        self.writeLines("d4.txt", ["no annotations"])
+        docs = self.docList(["d1", "d3", "d4"])
+        output = helpers.runScript("simple-merge.py", "--docs", docs, *self.annotations)
+        self.assertEqual(helpers.runScript("simple-merge.py", "--sorted", "--docs", docs, *self.annotations), output)
+        self.assertEqual([json.loads(line)["docID"] for line in output.splitlines()], ["d1", "d3"])
+
+    def testSortedSkipsUnreadableDocuments (self):
+        output = helpers.runScript("simple-merge.py", "--sorted", "--docs", self.docList(["d1", "d2", "d3"]), *self.annotations)
+        docs = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([doc["docID"] for doc in docs], ["d1", "d3"])
+        self.assertEqual([len(doc["annotations"]) for doc in docs], [1, 2])
+        self.assertEqual(docs[0]["annotations"][0]["offsets"], [[0, 5], [6, 11]])
+
+######################################################################
@@ -0,0 +1,58 @@
+"""
+Copyright 2015 The MITRE Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import csv
+import json
+import random
+import helpers
+
+######################################################################
+
+class simpleScoreTest (helpers.tempDirTest):
+
+    def setUp (self):
+        helpers.tempDirTest.setUp(self)
+        rng = random.Random(2)
+        self.responses = self.writeLines("responses.json",
+                                         [json.dumps({"WorkerId": "W%d" % rng.randrange(6), "Input.itemID": "I%d" % rng.randrange(20),
+                                                      "Answer.answer": rng.choice(["yes", "no"]),
+                                                      "WorkTimeInSeconds": str(rng.randrange(10, 100))})
+                                          for n in xrange(200)])
+        self.references = self.writeLines("references.tsv", ["I%d\t%s" % (i, rng.choice(["yes", "no"])) for i in xrange(20)])
+
+    def testTabSepKeepsOverallRecord (self):
+        for args in ((), ("--pr", "yes")):
+            args = ["--references", self.references] + list(args) + [self.responses]
+            overall = json.loads(helpers.runScript("simple-score.py", "--format", "json", *args).splitlines()[0])
+            rows = list(csv.DictReader(helpers.runScript("simple-score.py", "--format", "tsv", *args).splitlines(),
+                                       dialect=csv.excel_tab))
+            self.assertEqual(rows[0]["record"], "overall")
+            self.assertEqual(set(k for k, v in overall.iteritems() if v is not None),
+                             set(k for k, v in rows[0].iteritems() if v))
+            self.assertEqual(float(rows[0]["medianDuration"]), overall["medianDuration"])
+
+    def testStoreWithSomeColumns (self):
+        args = ["--references", self.references, "--format", "json"]
+        store = self.filename("store")
+        helpers.runScript("store-responses.py", "--store", store, "--columns",
+                          "WorkerId Input.itemID Answer.answer WorkTimeInSeconds AdjustedWorkTime", self.responses)
+        self.assertEqual(helpers.runScript("simple-score.py", "--store", store, *args),
+                         helpers.runScript("simple-score.py", *(args + [self.responses])))
+        # Without the work times, the store is refused up front
+        store = self.filename("short-store")
+        helpers.runScript("store-responses.py", "--store", store, "--columns", "WorkerId Input.itemID Answer.answer", self.responses)
+        error = helpers.runScriptFailing("simple-score.py", "--store", store, *args)
+        self.assertIn("no WorkTimeInSeconds column", error)
+        self.assertNotIn("KeyError", error)
+
+######################################################################